@@ -2,17 +2,41 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
 from trytond.pool import Pool
+from . import attachment
 from . import configuration
 from . import helpdesk
 from . import getmail
+from . import outbox
+from . import archive
+from . import ingest
+from . import summary
+from . import quarantine
+from . import party
 
 def register():
     Pool.register(
         configuration.HelpdeskConfiguration,
+        configuration.HelpdeskConfigurationBlockedAttachment,
         helpdesk.Helpdesk,
         helpdesk.HelpdeskTalk,
+        helpdesk.HelpdeskTalkReference,
         helpdesk.HelpdeskLog,
         helpdesk.HelpdeskAttachment,
+        helpdesk.HelpdeskAttachmentDigest,
+        attachment.Attachment,
+        outbox.HelpdeskOutbox,
+        outbox.Cron,
+        archive.HelpdeskTalkArchive,
+        archive.HelpdeskLogArchive,
+        archive.Cron,
+        ingest.HelpdeskIngestStat,
+        ingest.HelpdeskIngestStatStage,
+        ingest.Cron,
+        summary.HelpdeskSummary,
+        summary.Cron,
+        quarantine.HelpdeskQuarantine,
+        party.Party,
+        party.ContactMechanism,
         module='helpdesk', type_='model')
     Pool.register(
         getmail.GetmailServer,
@@ -0,0 +1,103 @@
+# This file is part of the helpdesk module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import zlib
+
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.pool import PoolMeta
+
+__all__ = ['HelpdeskTalkArchive', 'HelpdeskLogArchive', 'Cron']
+
+
+def compress(text):
+    'Return the compressed bytes of the text'
+    if text is None:
+        return None
+    return zlib.compress(text.encode('utf-8'))
+
+
+def decompress(data):
+    'Return the text of the compressed bytes'
+    if data is None:
+        return None
+    return zlib.decompress(bytes(data)).decode('utf-8')
+
+
+class HelpdeskTalkArchive(ModelSQL, ModelView):
+    'Helpdesk Talk Archive'
+    __name__ = 'helpdesk.talk.archive'
+    helpdesk = fields.Many2One('helpdesk', 'Helpdesk', required=True,
+        ondelete='CASCADE', select=True, readonly=True)
+    talk_id = fields.Integer('Talk ID', required=True, readonly=True)
+    date = fields.DateTime('Date', readonly=True)
+    email = fields.Char('email', readonly=True)
+    message = fields.Function(fields.Text('Message'), 'get_message')
+    message_compressed = fields.Binary('Message Compressed', readonly=True)
+    original = fields.Function(fields.Text('Original Message'),
+        'get_original')
+    original_compressed = fields.Binary('Original Message Compressed',
+        readonly=True)
+    snippet = fields.Text('Snippet', readonly=True)
+    unread = fields.Boolean('Unread', readonly=True)
+    message_id = fields.Char('Message ID', readonly=True)
+    email_state = fields.Selection([
+            (None, ''),
+            ('pending', 'Pending'),
+            ('sent', 'Sent'),
+            ('failed', 'Failed'),
+            ], 'Email State', readonly=True)
+    references = fields.Text('References', readonly=True)
+    parent_id = fields.Integer('Parent ID', readonly=True)
+    path = fields.Char('Path', readonly=True)
+    depth = fields.Integer('Depth', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(HelpdeskTalkArchive, cls).__setup__()
+        cls._order = [
+            ('talk_id', 'DESC'),
+            ]
+
+    @classmethod
+    def __register__(cls, module_name):
+        super(HelpdeskTalkArchive, cls).__register__(module_name)
+
+        table_h = cls.__table_handler__(module_name)
+        table_h.index_action(['message_id', 'helpdesk'], 'add')
+
+    @classmethod
+    def get_message(cls, archives, name):
+        return {a.id: decompress(a.message_compressed) for a in archives}
+
+    @classmethod
+    def get_original(cls, archives, name):
+        return {a.id: (decompress(a.original_compressed)
+                if a.original_compressed else a.message) for a in archives}
+
+
+class HelpdeskLogArchive(ModelSQL, ModelView):
+    'Helpdesk Log Archive'
+    __name__ = 'helpdesk.log.archive'
+    helpdesk = fields.Many2One('helpdesk', 'Helpdesk', required=True,
+        ondelete='CASCADE', select=True, readonly=True)
+    log_id = fields.Integer('Log ID', required=True, readonly=True)
+    name = fields.Char('Action', readonly=True)
+    date = fields.DateTime('Date', readonly=True)
+    user = fields.Many2One('res.user', 'User', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(HelpdeskLogArchive, cls).__setup__()
+        cls._order = [
+            ('log_id', 'DESC'),
+            ]
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super(Cron, cls).__setup__()
+        cls.method.selection.append(
+            ('helpdesk|archive_done', 'Archive Done Helpdesks'))
@@ -0,0 +1,57 @@
+# This file is part of the helpdesk module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.pool import Pool, PoolMeta
+
+__all__ = ['Attachment']
+
+
+class Attachment(metaclass=PoolMeta):
+    __name__ = 'ir.attachment'
+
+    @staticmethod
+    def get_helpdesk_ids(attachments):
+        'Return the ids of the helpdesks related to the attachments'
+        Helpdesk = Pool().get('helpdesk')
+        return {a.resource.id for a in attachments
+            if isinstance(a.resource, Helpdesk)}
+
+    @classmethod
+    def create(cls, vlist):
+        Helpdesk = Pool().get('helpdesk')
+
+        attachments = super(Attachment, cls).create(vlist)
+
+        helpdesk_ids = cls.get_helpdesk_ids(attachments)
+        if helpdesk_ids:
+            Helpdesk.update_attachment_count(list(helpdesk_ids))
+        return attachments
+
+    @classmethod
+    def write(cls, *args):
+        Helpdesk = Pool().get('helpdesk')
+
+        attachments = []
+        actions = iter(args)
+        for records, values in zip(actions, actions):
+            if 'resource' in values:
+                attachments.extend(records)
+        helpdesk_ids = cls.get_helpdesk_ids(attachments)
+
+        super(Attachment, cls).write(*args)
+
+        helpdesk_ids |= cls.get_helpdesk_ids(
+            cls.browse([a.id for a in attachments]))
+        if helpdesk_ids:
+            Helpdesk.update_attachment_count(list(helpdesk_ids))
+
+    @classmethod
+    def delete(cls, attachments):
+        Helpdesk = Pool().get('helpdesk')
+
+        helpdesk_ids = cls.get_helpdesk_ids(attachments)
+
+        super(Attachment, cls).delete(attachments)
+
+        if helpdesk_ids:
+            Helpdesk.update_attachment_count(list(helpdesk_ids))
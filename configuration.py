@@ -1,11 +1,124 @@
 # This file is part helpdesk module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
-from trytond.model import ModelView, ModelSQL, ModelSingleton
+from trytond import backend
+from trytond.model import ModelView, ModelSQL, ModelSingleton, fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
 
-__all__ = ['HelpdeskConfiguration']
+__all__ = ['HelpdeskConfiguration', 'HelpdeskConfigurationBlockedAttachment']
 
 
 class HelpdeskConfiguration(ModelSingleton, ModelSQL, ModelView):
     'Helpdesk Configuration'
     __name__ = 'helpdesk.configuration'
+    blocked_attachments = fields.One2Many(
+        'helpdesk.configuration.blocked_attachment', 'configuration',
+        'Blocked Attachments',
+        help='Email attachments with the same content of these files, for '
+            'example, signatures or logos, are never stored.')
+    attachment_max_size = fields.Integer('Attachment Max Size',
+        help='Maximum size in bytes of the email attachments to store. '
+            'Bigger attachments are not stored and a note is added to the '
+            'talk. Leave empty for no limit.')
+    getmail_workers = fields.Integer('Email Parse Workers',
+        help='Number of processes used to parse the body of the received '
+            'emails. Leave empty or 1 to parse them in the server process.')
+    getmail_chunk_size = fields.Integer('Email Chunk Size',
+        help='Number of received emails loaded and committed together. The '
+            'emails of a failed chunk are loaded one by one and the failing '
+            'ones are quarantined. Leave empty to load all the emails of a '
+            'run in one transaction.')
+    strip_reply = fields.Boolean('Strip Quoted Replies',
+        help='Store only the new content of the received replies. The '
+            'original message is kept compressed on the talk.')
+    party_cache = fields.Boolean('Cache Email Parties',
+        help='Keep the parties found for the email senders between getmail '
+            'runs until the contact mechanisms change.')
+    archive_delay = fields.Integer('Archive Delay',
+        help='Days after closing a helpdesk before its talks and logs are '
+            'moved to the archive. Leave empty to never archive.')
+    ingest_stat_retention = fields.Integer('Ingest Statistics Retention',
+        help='Days the ingest statistics are kept. Leave empty to keep them '
+            'forever.')
+    outbox_batch_size = fields.Integer('Outbox Batch Size',
+        help='Maximum number of emails delivered to each SMTP server on '
+            'each run of the outbox. Leave empty for no limit.')
+    outbox_max_attempts = fields.Integer('Outbox Max Attempts',
+        help='Number of delivery attempts before an email is marked as '
+            'failed.')
+    outbox_retry_delay = fields.Integer('Outbox Retry Delay',
+        help='Seconds to wait before the first retry of a failed delivery. '
+            'The delay is doubled on each attempt.')
+
+    @classmethod
+    def __register__(cls, module_name):
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        exist = backend.TableHandler.table_exist(cls._table)
+        if exist:
+            table_h = cls.__table_handler__(module_name)
+            fill_retention = not table_h.column_exist(
+                'ingest_stat_retention')
+
+        super(HelpdeskConfiguration, cls).__register__(module_name)
+
+        # Purge the statistics of the existing configuration as the new ones
+        if exist and fill_retention:
+            cursor.execute(*table.update([table.ingest_stat_retention],
+                    [cls.default_ingest_stat_retention()]))
+
+    @staticmethod
+    def default_ingest_stat_retention():
+        return 30
+
+    @staticmethod
+    def default_strip_reply():
+        return False
+
+    @staticmethod
+    def default_outbox_batch_size():
+        return 100
+
+    @staticmethod
+    def default_outbox_max_attempts():
+        return 5
+
+    @staticmethod
+    def default_outbox_retry_delay():
+        return 60
+
+
+class HelpdeskConfigurationBlockedAttachment(ModelSQL, ModelView):
+    'Helpdesk Configuration Blocked Attachment'
+    __name__ = 'helpdesk.configuration.blocked_attachment'
+    configuration = fields.Many2One('helpdesk.configuration', 'Configuration',
+        required=True, ondelete='CASCADE')
+    name = fields.Char('Name')
+    file = fields.Function(fields.Binary('File', filename='name'),
+        'get_file', setter='set_file')
+    digest = fields.Char('Digest', required=True, select=True)
+
+    @staticmethod
+    def default_configuration():
+        Configuration = Pool().get('helpdesk.configuration')
+        # The configuration is a singleton
+        return Configuration(1).id
+
+    @fields.depends('file')
+    def on_change_file(self):
+        AttachmentDigest = Pool().get('helpdesk.attachment.digest')
+        if self.file:
+            self.digest = AttachmentDigest.get_digest(self.file)
+
+    @classmethod
+    def get_file(cls, blocked_attachments, name):
+        return {b.id: None for b in blocked_attachments}
+
+    @classmethod
+    def set_file(cls, blocked_attachments, name, value):
+        AttachmentDigest = Pool().get('helpdesk.attachment.digest')
+        if value:
+            cls.write(blocked_attachments, {
+                    'digest': AttachmentDigest.get_digest(value),
+                    })
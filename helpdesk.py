@@ -1,7 +1,7 @@
 # This file is part of the helpdesk module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
-from datetime import datetime
+from datetime import datetime, timedelta
 from email.header import Header
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
@@ -9,19 +9,33 @@ from email.mime.base import MIMEBase
 from email.encoders import encode_base64
 from email.utils import parseaddr, make_msgid
 from html2text import html2text
-from sql.aggregate import Count
+from sql import Cast, Column, Literal, Null, Select
+from sql.functions import CharLength, CurrentTimestamp, Function, Substring
+from sql.aggregate import Count, Max, StringAgg
+from sql.conditionals import Case, Coalesce
+from sql.operators import Concat, Not
+from trytond import backend
+from trytond.cache import Cache
+from trytond.config import config
 from trytond.model import Workflow, ModelView, ModelSQL, fields
 from trytond.pool import Pool
-from trytond.tools import cursor_dict
+from trytond.tools import grouped_slice, reduce_ids, cursor_dict
 from trytond.pyson import Eval, If, Equal, In
+from trytond.rpc import RPC
 from trytond.transaction import Transaction
 from trytond.i18n import gettext
 from trytond.exceptions import UserError
 from trytond.sendmail import SMTPDataManager, sendmail_transactional
+from concurrent.futures import ProcessPoolExecutor
+from .archive import compress, decompress
+from .ingest import IngestStats
+import hashlib
 import mimetypes
 import dateutil.tz
 import re
 import logging
+import time
+import traceback
 
 logger = logging.getLogger(__name__)
 
@@ -37,7 +51,8 @@ try:
 except:
     pytz = None
 
-__all__ = ['Helpdesk', 'HelpdeskTalk', 'HelpdeskLog', 'HelpdeskAttachment']
+__all__ = ['Helpdesk', 'HelpdeskTalk', 'HelpdeskTalkReference', 'HelpdeskLog',
+    'HelpdeskAttachment', 'HelpdeskAttachmentDigest']
 
 PREFIX_REPLY = ['re', 'fw', 'fwd', 'fw', 'was', 'ot', 'eom', 'ab', 'ar', 'fya',
     'fysa', 'fyfg', 'fyg', 'i', 'let', 'lsfw', 'nim', 'nls', 'nm', 'nmp',
@@ -47,6 +62,286 @@ PREFIX_REPLY = ['re', 'fw', 'fwd', 'fw', 'was', 'ot', 'eom', 'ab', 'ar', 'fya',
     're', 'odp', 'ynt', 'doorst', 'vl', 'tr', 'wg', 'fs', 'vs', 'vb', 'rv',
     'enc', 'pd']
 
+EMAIL_SEPARATOR = re.compile('[,;]')
+EMAIL_ADDRESS = re.compile(r'[\w\.-]+@[\w\.-]+')
+# not replace html2text an email string: "User <user@domain.com>"
+EMAIL_BRACKETS = re.compile('<([^<]*@[^>]*)>', re.M | re.I)
+# Reply headers of Gmail, Apple Mail and Thunderbird: "On ... wrote:"
+REPLY_HEADER_START = re.compile(r'^(on|el|le|am|il|op|em|den|w dniu)\s',
+    re.I)
+REPLY_HEADER = re.compile(r'^(on|el|le|am|il|op|em|den|w dniu)\s.{0,300}\s'
+    r'(wrote|escribió|va escriure|a écrit|schrieb|ha scritto|schreef|'
+    r'escreveu|skrev|napisał\(a\)|napisał)(\s[^:]{0,200})?\s?:$', re.I)
+# Original message headers of Outlook
+REPLY_SEPARATOR = re.compile(r'^-{2,}\s*(original message|mensaje original|'
+    r'missatge original|message d\'origine|ursprüngliche nachricht|'
+    r'messaggio originale|oorspronkelijk bericht|mensagem original)'
+    r'\s*-{2,}$', re.I)
+REPLY_FROM = re.compile(r'^(from|de|von|da|van|od|från|fra)\s?:', re.I)
+REPLY_SENT = re.compile(r'^(sent|date|enviado|fecha|enviat|data|envoyé|'
+    r'gesendet|datum|inviato|verzonden|skickat|sendt|wysłano)\s?:', re.I)
+REPLY_TO = re.compile(r'^(to|subject|para|asunto|assumpte|à|objet|an|'
+    r'betreff|a|oggetto|aan|onderwerp|assunto|do|temat|till|ämne|til|emne)'
+    r'\s?:', re.I)
+# Horizontal rules, html2text writes them as "* * *"
+SEPARATOR_LINE = re.compile(r'^([-_=*]\s*){3,}$')
+
+
+def parse_references(references, message_id, in_reply_to=None):
+    'Return the list of message ids referenced by an email message'
+    if references:
+        if ',' in references:  # Hotmail Reply References
+            references = references.split(',')
+        elif '\r\n' in references:  # Gmail Replay References
+            references = references.split('\r\n')
+        elif ' ' in references:  # Yahoo References
+            references = references.split(' ')
+        else:
+            references = [references]
+        references = [r.strip() for r in references if r.strip()]
+    if not references:
+        references = [message_id]
+    if in_reply_to:
+        references.append(in_reply_to)
+    return references
+
+
+def thread_root(references, message_id, in_reply_to=None):
+    '''Return the message id of the first message of the thread
+
+    It is the first id of the references, or the in reply to or the message
+    id when there are no references.
+    '''
+    references = [r for r in parse_references(references, None) if r]
+    if references:
+        return references[0]
+    return (in_reply_to or '').strip() or message_id
+
+
+def lock_key(value):
+    'Return the 64 bits lock id of the text'
+    digest = hashlib.md5(value.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big', signed=True)
+
+
+def try_lock(keys):
+    '''Lock the texts until the end of the transaction
+
+    It returns False when the database does not support the locks by id and
+    raises DatabaseOperationalError when a text is locked by another
+    transaction.
+    '''
+    transaction = Transaction()
+    database = transaction.database
+    cursor = transaction.connection.cursor()
+    try:
+        database.lock_id(0)
+    except NotImplementedError:
+        return False
+    for sub_ids in grouped_slice(sorted({lock_key(k) for k in keys}), 100):
+        cursor.execute(*Select([database.lock_id(i) for i in sub_ids]))
+        if not all(cursor.fetchone()):
+            raise backend.DatabaseOperationalError(
+                'Locked by another transaction')
+    return True
+
+
+def is_quote(line):
+    'Return if the html2text line is quoted'
+    line = line.lstrip()
+    return line.startswith('>') or line.startswith('\\>')
+
+
+def strip_reply(text):
+    '''Return the new content of a reply without the quoted messages
+
+    The text is cut at the reply header of the email clients when only
+    quoted lines follow it, or at the original message headers of Outlook,
+    and the quoted lines at the end are removed. The From and Sent headers
+    of Outlook must follow a separator line or come with a To or Subject
+    header, so a text that only starts a line with "From:" is kept. The
+    whole text is returned when nothing is left.
+    '''
+    if not text:
+        return text
+    lines = text.split('\n')
+    # Without the bold and italic marks of html2text
+    clean = [l.replace('*', '').strip() for l in lines]
+    end = len(lines)
+    for i, line in enumerate(clean):
+        if not line or is_quote(line):
+            continue
+        if REPLY_SEPARATOR.match(line):
+            end = i
+            break
+        if REPLY_FROM.match(line):
+            block = []
+            for l in clean[i + 1:i + 6]:
+                if not l:
+                    break
+                block.append(l)
+            previous = [l.strip() for l in lines[:i] if l.strip()]
+            if (any(REPLY_SENT.match(l) for l in block[:3])
+                    and ((previous and SEPARATOR_LINE.match(previous[-1]))
+                        or any(REPLY_TO.match(l) for l in block))):
+                end = i
+                break
+        if REPLY_HEADER_START.match(line):
+            # html2text wraps the long headers on several lines
+            for j in range(i + 1, min(i + 4, len(lines) + 1)):
+                if REPLY_HEADER.match(' '.join(clean[i:j])):
+                    break
+            else:
+                continue
+            # Keep the answers between the quotes of the inline replies
+            if all(not l or is_quote(l) for l in clean[j:]):
+                end = i
+                break
+    while end and (not clean[end - 1] or is_quote(clean[end - 1])
+            or SEPARATOR_LINE.match(clean[end - 1])):
+        end -= 1
+    if not end:
+        return text
+    return '\n'.join(lines[:end])
+
+
+def parse_message(values):
+    '''Return the normalized addresses, references and body of an email
+
+    It does not use the pool nor the transaction, so it can be run in a
+    worker process.
+    '''
+    msgfrom = (parseaddr(EMAIL_SEPARATOR.sub('', values['from_addr']))[1]
+        if values['from_addr'] else None)
+    msgcc = None
+    if values['cc']:
+        ccs = EMAIL_ADDRESS.findall(values['cc'])
+        if ccs:
+            msgcc = ",".join(ccs)
+    msgbody = EMAIL_BRACKETS.sub(r'\g<1>', values['body'] or '')
+    msgbody = html2text(msgbody.replace('\n', '<br>'))
+    original = None
+    if values.get('strip_reply'):
+        stripped = strip_reply(msgbody)
+        if stripped.rstrip() != msgbody.rstrip():
+            original, msgbody = msgbody, stripped
+    return {
+        'message_id': values['message_id'],
+        'from': msgfrom,
+        'cc': msgcc,
+        'references': parse_references(values['references'],
+            values['message_id'], values['in_reply_to']),
+        'in_reply_to': (values['in_reply_to'] or '').strip() or None,
+        'subject': values['title'] or 'Not subject',
+        'body': msgbody,
+        'original': original,
+        }
+
+
+def clear_cache(Model, ids=None):
+    'Clear the transaction cache of records updated with SQL'
+    transaction = Transaction()
+    transaction.counter += 1
+    for cache in transaction.cache.values():
+        if Model.__name__ in cache:
+            if ids is None:
+                cache.pop(Model.__name__)
+                continue
+            for id_ in ids:
+                cache[Model.__name__].pop(id_, None)
+
+
+class Row(Function):
+    __slots__ = ()
+    _function = 'ROW'
+
+
+class Setweight(Function):
+    __slots__ = ()
+    _function = 'setweight'
+
+
+class LastTalkDataManager(object):
+    'Update the last talk of the changed helpdesks once per transaction'
+
+    def __init__(self):
+        self.ids = set()
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return True
+
+    def abort(self, trans):
+        self._finish()
+
+    def tpc_begin(self, trans):
+        pass
+
+    def commit(self, trans):
+        if self.ids:
+            Helpdesk = Pool().get('helpdesk')
+            Helpdesk.update_last_talk(list(self.ids))
+
+    def tpc_vote(self, trans):
+        pass
+
+    def tpc_finish(self, trans):
+        self._finish()
+
+    def tpc_abort(self, trans):
+        self._finish()
+
+    def _finish(self):
+        self.ids = set()
+
+
+class FullTextDataManager(LastTalkDataManager):
+    '''Update the full text of the changed helpdesks once per transaction
+
+    The talks of the helpdesks in ids are rebuilt, the new talks are
+    appended and only the name and message are updated for the others.
+    '''
+
+    def __init__(self):
+        super(FullTextDataManager, self).__init__()
+        self.talks = {}
+        self.document_ids = set()
+
+    def commit(self, trans):
+        Helpdesk = Pool().get('helpdesk')
+        if self.ids:
+            Helpdesk.update_full_text(list(self.ids))
+        talk_ids = [t for t, h in self.talks.items() if h not in self.ids]
+        if talk_ids:
+            Helpdesk.append_full_text(talk_ids)
+        document_ids = self.document_ids - self.ids - set(self.talks.values())
+        if document_ids:
+            Helpdesk.update_full_text_document(list(document_ids))
+
+    def _finish(self):
+        super(FullTextDataManager, self)._finish()
+        self.talks = {}
+        self.document_ids = set()
+
+
+class HelpdeskSMTPDataManager(SMTPDataManager):
+    'Send the emails of a SMTP server with one connection per transaction'
+
+    def __init__(self, server):
+        super(HelpdeskSMTPDataManager, self).__init__()
+        self.server = server.id
+
+    def __eq__(self, other):
+        if not isinstance(other, HelpdeskSMTPDataManager):
+            return False
+        return self.server == other.server
+
+    def tpc_vote(self, trans):
+        if self._server is None and self.queue:
+            SMTP = Pool().get('smtp.server')
+            self._server = SMTP(self.server).get_smtp_server()
+
 
 class Helpdesk(Workflow, ModelSQL, ModelView):
     'Helpdesk'
@@ -122,10 +417,19 @@ class Helpdesk(Workflow, ModelSQL, ModelView):
         depends=['state'])
     logs = fields.One2Many('helpdesk.log', 'helpdesk',
         'Logs Helpdesk', readonly=True)
+    archived = fields.Boolean('Archived', readonly=True, select=True,
+        help='The talks and logs are moved to the archive. They are moved '
+            'back when the helpdesk is reopened.')
+    archived_talks = fields.One2Many('helpdesk.talk.archive', 'helpdesk',
+        'Archived Communication', readonly=True)
+    archived_logs = fields.One2Many('helpdesk.log.archive', 'helpdesk',
+        'Archived Logs', readonly=True)
     message_id = fields.Char('Message ID')
     last_talk = fields.DateTime('Last Talk', readonly=True)
     num_attach = fields.Function(fields.Integer('Attachments'),
-        'get_num_attachments')
+        'get_num_attachments', searcher='search_num_attachments')
+    attachment_count = fields.Integer('Attachments Count', readonly=True,
+        select=True)
     attachments = fields.One2Many('ir.attachment', 'resource', 'Attachments',
         help='Attachments fields related in this helpdesk. Remember to remove '
             'email attachments not necessary, for example, signatures, logos, '
@@ -139,9 +443,14 @@ class Helpdesk(Workflow, ModelSQL, ModelView):
             ' attachemtns will be remove from this list.')
     unread = fields.Function(fields.Boolean('Unread'),
         'get_unread', setter='set_unread', searcher='search_unread')
+    unread_count = fields.Integer('Unread Talks', readonly=True, select=True)
+    full_text = fields.Function(fields.Text('Full Text',
+            help='Search the words of the name, the message and the talks.'),
+        'get_full_text', searcher='search_full_text')
     kind = fields.Selection([
             ('generic', 'Generic'),
             ], 'Kind')
+    _party_cache = Cache('helpdesk.party_from_email', context=False)
 
     @classmethod
     def __setup__(cls):
@@ -184,6 +493,50 @@ class Helpdesk(Workflow, ModelSQL, ModelView):
                     'invisible': Eval('state') != 'open',
                     },
                 })
+        cls.__rpc__.update({
+                'search_keyset': RPC(readonly=True),
+                })
+
+    @classmethod
+    def __register__(cls, module_name):
+        cursor = Transaction().connection.cursor()
+        exist = backend.TableHandler.table_exist(cls._table)
+        if exist:
+            table_h = cls.__table_handler__(module_name)
+            fill_unread_count = not table_h.column_exist('unread_count')
+            fill_attachment_count = not table_h.column_exist(
+                'attachment_count')
+
+        super(Helpdesk, cls).__register__(module_name)
+
+        # Migration from 6.0: fill unread_count and attachment_count
+        if exist and fill_unread_count:
+            cls.update_unread_count()
+        if exist and fill_attachment_count:
+            cls.update_attachment_count()
+
+        # Indexes of the default order for the lists filtered by employee
+        # and state and for the keyset pagination
+        for name, columns in [
+                ('helpdesk_employee_state_order_index',
+                    '"employee", "state", '),
+                ('helpdesk_state_order_index', '"state", '),
+                ('helpdesk_order_index', ''),
+                ]:
+            cursor.execute('CREATE INDEX IF NOT EXISTS "%s" ON "helpdesk" '
+                '(%s"priority", "date" DESC, "id" DESC)' % (name, columns))
+
+        if Transaction().database.has_search_full_text():
+            table_h = cls.__table_handler__(module_name)
+            fill_full_text = (not table_h.column_exist('full_text_document')
+                or not table_h.column_exist('full_text_talks'))
+            table_h.add_column('full_text_document', 'TSVECTOR')
+            table_h.add_column('full_text_talks', 'TSVECTOR')
+            cursor.execute('CREATE INDEX IF NOT EXISTS '
+                '"helpdesk_full_text_document_index" ON "helpdesk" '
+                'USING GIN ("full_text_document")')
+            if exist and fill_full_text:
+                cls.update_full_text()
 
     @classmethod
     def get_origin(cls):
@@ -194,56 +547,263 @@ class Helpdesk(Workflow, ModelSQL, ModelView):
                 ])
         return [('', '')] + [(m.model, m.name) for m in models]
 
-    def get_unread(self, name):
-        for talk in self.talks:
-            if talk.unread:
-                return True
-        return False
+    @classmethod
+    def get_unread(cls, helpdesks, name):
+        return {h.id: bool(h.unread_count) for h in helpdesks}
 
     @classmethod
     def set_unread(cls, helpdesks, name, value):
         HelpdeskTalk = Pool().get('helpdesk.talk')
-        for helpdesk in helpdesks:
-            if not helpdesk.talks:
-                continue
-            HelpdeskTalk.write(list(helpdesk.talks), {'unread': value})
+        talk = HelpdeskTalk.__table__()
+        cursor = Transaction().connection.cursor()
+
+        ids = [h.id for h in helpdesks]
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*talk.update(
+                    [talk.unread], [bool(value)],
+                    where=reduce_ids(talk.helpdesk, sub_ids)))
+        clear_cache(HelpdeskTalk)
+        cls.update_unread_count(ids)
 
     @classmethod
     def search_unread(cls, name, clause):
+        _, operator, value = clause
+        if operator == '!=':
+            value = not value
+        if value:
+            return [('unread_count', '>', 0)]
+        return [('unread_count', 'in', [0, None])]
+
+    @classmethod
+    def update_unread_count(cls, ids=None):
+        'Update the number of unread talks of the helpdesks'
+        pool = Pool()
+        HelpdeskTalk = pool.get('helpdesk.talk')
+        Summary = pool.get('helpdesk.summary')
+        table = cls.__table__()
+        talk = HelpdeskTalk.__table__()
+        cursor = Transaction().connection.cursor()
+
+        unread_count = talk.select(Count(Literal('*')),
+            where=(talk.helpdesk == table.id)
+            & (talk.unread == Literal(True)))
+        if ids is None:
+            cursor.execute(*table.update(
+                    [table.unread_count], [unread_count]))
+            if backend.TableHandler.table_exist(Summary._table):
+                Summary.update_summary()
+            return
+        ids = list(set(ids))
+        old_values = Summary.get_values(ids)
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*table.update(
+                    [table.unread_count], [unread_count],
+                    where=reduce_ids(table.id, sub_ids)))
+        clear_cache(cls, ids)
+        Summary.set_summary(old_values, Summary.get_values(ids))
+
+    @classmethod
+    def update_last_talk(cls, ids):
+        'Update the last talk date of the helpdesks'
+        HelpdeskTalk = Pool().get('helpdesk.talk')
+        table = cls.__table__()
+        talk = HelpdeskTalk.__table__()
         cursor = Transaction().connection.cursor()
-        unread = 't' if clause[2] else 'f'
-        cursor.execute('''
-            SELECT
-                h.id
-            FROM
-                    helpdesk as h
-                LEFT JOIN
-                    helpdesk_talk as ht
-                ON
-                    ht.helpdesk = h.id
-            WHERE
-                ht.unread = '%s'
-            GROUP BY
-                h.id
-            ''' % unread)
-        return [('id', 'in', [x[0] for x in cursor.fetchall()])]
+
+        last_talk = talk.select(Max(talk.date),
+            where=talk.helpdesk == table.id)
+        ids = list(set(ids))
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*table.update(
+                    [table.last_talk],
+                    [Coalesce(last_talk, table.last_talk)],
+                    where=reduce_ids(table.id, sub_ids)))
+        clear_cache(cls, ids)
 
     @classmethod
     def get_num_attachments(cls, helpdesks, name):
+        return {h.id: h.attachment_count for h in helpdesks}
+
+    @classmethod
+    def search_num_attachments(cls, name, clause):
+        return [('attachment_count',) + tuple(clause[1:])]
+
+    @classmethod
+    def update_attachment_count(cls, ids=None):
+        'Update the number of attachments of the helpdesks'
         Attachment = Pool().get('ir.attachment')
+        table = cls.__table__()
         attachment = Attachment.__table__()
         cursor = Transaction().connection.cursor()
-        res = {h.id: None for h in helpdesks}
-        cursor.execute(*attachment.select(
-            attachment.resource.as_('resource'),
-            Count(attachment.id).as_(name),
-            where=attachment.resource.in_(
-                ['helpdesk,%s' % str(h.id) for h in helpdesks]),
-            group_by=attachment.resource))
-        res.update({
-                int(r['resource'].split(',')[1]): r[name]
-                for r in cursor_dict(cursor)})
-        return res
+
+        resource = Concat(cls.__name__ + ',',
+            Cast(table.id, Attachment.resource.sql_type().base))
+        attachment_count = attachment.select(Count(Literal('*')),
+            where=attachment.resource == resource)
+        if ids is None:
+            cursor.execute(*table.update(
+                    [table.attachment_count], [attachment_count]))
+            return
+        ids = list(set(ids))
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*table.update(
+                    [table.attachment_count], [attachment_count],
+                    where=reduce_ids(table.id, sub_ids)))
+        clear_cache(cls, ids)
+
+    @classmethod
+    def get_full_text(cls, helpdesks, name):
+        return {h.id: None for h in helpdesks}
+
+    @classmethod
+    def _full_text_query(cls, value):
+        'Return the full text query of the search value'
+        pool = Pool()
+        Configuration = pool.get('ir.configuration')
+        database = Transaction().database
+        value = (value or '').replace('%', ' ').replace('_', ' ')
+        return database.format_full_text_query(value,
+            language=Configuration.get_language())
+
+    @classmethod
+    def search_full_text(cls, name, clause):
+        _, operator, value = clause
+        negative = operator.startswith('!') or operator.startswith('not ')
+        database = Transaction().database
+        if not database.has_search_full_text():
+            domain = ['OR',
+                ('name', 'ilike', value),
+                ('message', 'ilike', value),
+                ('talks.message', 'ilike', value),
+                ]
+            if negative:
+                return [('id', 'not in', cls.search(domain, query=True))]
+            return domain
+
+        table = cls.__table__()
+        expression = database.search_full_text(
+            Column(table, 'full_text_document'), cls._full_text_query(value))
+        if negative:
+            expression = Not(expression)
+        return [('id', 'in', table.select(table.id, where=expression))]
+
+    @classmethod
+    def order_full_text(cls, tables):
+        'Order by the rank of the full_text value of the context'
+        table, _ = tables[None]
+        database = Transaction().database
+        value = Transaction().context.get('full_text')
+        if not value or not database.has_search_full_text():
+            return [Null]
+        return [database.rank_full_text(Column(table, 'full_text_document'),
+                cls._full_text_query(value), normalize=['rank'])]
+
+    @classmethod
+    def order_priority(cls, tables):
+        'Order by the column to use the order indexes'
+        # The labels start with the value, so they have the same order
+        table, _ = tables[None]
+        return [table.priority]
+
+    @classmethod
+    def _full_text_talks(cls, where):
+        'Return the full text of the messages of the talks'
+        pool = Pool()
+        Configuration = pool.get('ir.configuration')
+        HelpdeskTalk = pool.get('helpdesk.talk')
+        table = cls.__table__()
+        talk = HelpdeskTalk.__table__()
+        database = Transaction().database
+
+        messages = talk.select(StringAgg(talk.message, '\n'),
+            where=(talk.helpdesk == table.id) & where(talk))
+        return table, Setweight(database.format_full_text(
+                Coalesce(messages, ''),
+                language=Configuration.get_language()), 'C')
+
+    @classmethod
+    def update_full_text(cls, ids=None):
+        'Rebuild the full text of the talks and the document of the helpdesks'
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        if not transaction.database.has_search_full_text():
+            return
+        table, talks = cls._full_text_talks(lambda talk: Literal(True))
+        column = Column(table, 'full_text_talks')
+        if ids is None:
+            cursor.execute(*table.update([column], [talks]))
+        else:
+            for sub_ids in grouped_slice(list(set(ids))):
+                cursor.execute(*table.update([column], [talks],
+                        where=reduce_ids(table.id, sub_ids)))
+        cls.update_full_text_document(ids)
+
+    @classmethod
+    def append_full_text(cls, talk_ids):
+        '''Append the messages of the new talks to the full text of their
+        helpdesks'''
+        HelpdeskTalk = Pool().get('helpdesk.talk')
+        talk = HelpdeskTalk.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        if not transaction.database.has_search_full_text():
+            return
+        helpdesk_ids = set()
+        for sub_ids in grouped_slice(list(set(talk_ids))):
+            sub_ids = list(sub_ids)
+            table, talks = cls._full_text_talks(
+                lambda t: reduce_ids(t.id, sub_ids))
+            column = Column(table, 'full_text_talks')
+            cursor.execute(*talk.select(talk.helpdesk,
+                    where=reduce_ids(talk.id, sub_ids),
+                    group_by=[talk.helpdesk]))
+            sub_helpdesk_ids = [h for h, in cursor.fetchall()]
+            cursor.execute(*table.update([column],
+                    [Concat(Coalesce(column, ''), talks)],
+                    where=reduce_ids(table.id, sub_helpdesk_ids)))
+            helpdesk_ids.update(sub_helpdesk_ids)
+        cls.update_full_text_document(list(helpdesk_ids))
+
+    @classmethod
+    def update_full_text_document(cls, ids=None):
+        '''Update the full text document of the helpdesks from their name,
+        message and the full text of their talks'''
+        Configuration = Pool().get('ir.configuration')
+        table = cls.__table__()
+        transaction = Transaction()
+        database = transaction.database
+        cursor = transaction.connection.cursor()
+
+        if not database.has_search_full_text():
+            return
+        document = Concat(database.format_full_text(
+                Coalesce(table.name, ''),
+                Coalesce(table.message, ''),
+                language=Configuration.get_language()),
+            Coalesce(Column(table, 'full_text_talks'), ''))
+        column = Column(table, 'full_text_document')
+        if ids is None:
+            cursor.execute(*table.update([column], [document]))
+            return
+        for sub_ids in grouped_slice(list(set(ids))):
+            cursor.execute(*table.update([column], [document],
+                    where=reduce_ids(table.id, sub_ids)))
+
+    @staticmethod
+    def set_full_text(helpdesk_ids=None, talks=None, document_ids=None):
+        '''Defer the update of the full text to the commit
+
+        The full text of the helpdesk_ids is rebuilt, the talks are appended
+        and only the name and message of the document_ids are updated.
+        '''
+        if not Transaction().database.has_search_full_text():
+            return
+        datamanager = Transaction().join(FullTextDataManager())
+        datamanager.ids.update(helpdesk_ids or [])
+        datamanager.talks.update((t.id, t.helpdesk.id) for t in talks or [])
+        datamanager.document_ids.update(document_ids or [])
 
     @fields.depends('party', 'email_from')
     def on_change_party(self):
@@ -292,12 +852,55 @@ class Helpdesk(Workflow, ModelSQL, ModelView):
     def default_kind():
         return Transaction().context.get('kind', 'generic')
 
+    @staticmethod
+    def default_unread_count():
+        return 0
+
+    @staticmethod
+    def default_attachment_count():
+        return 0
+
+    @staticmethod
+    def default_archived():
+        return False
+
+    @classmethod
+    def create(cls, vlist):
+        Summary = Pool().get('helpdesk.summary')
+        helpdesks = super(Helpdesk, cls).create(vlist)
+        ids = [h.id for h in helpdesks]
+        cls.set_full_text(document_ids=ids)
+        Summary.set_summary([], Summary.get_values(ids))
+        return helpdesks
+
+    @classmethod
+    def write(cls, *args):
+        Summary = Pool().get('helpdesk.summary')
+        helpdesk_ids = set()
+        summary_ids = set()
+        actions = iter(args)
+        for helpdesks, values in zip(actions, actions):
+            if {'name', 'message'} & set(values):
+                helpdesk_ids.update(h.id for h in helpdesks)
+            if {'employee', 'kind', 'state', 'unread_count'} & set(values):
+                summary_ids.update(h.id for h in helpdesks)
+        old_values = Summary.get_values(summary_ids)
+        super(Helpdesk, cls).write(*args)
+        if helpdesk_ids:
+            cls.set_full_text(document_ids=helpdesk_ids)
+        if summary_ids:
+            Summary.set_summary(old_values, Summary.get_values(summary_ids))
+
     @classmethod
     def delete(cls, helpdesks):
-        Attachment = Pool().get('ir.attachment')
+        pool = Pool()
+        Attachment = pool.get('ir.attachment')
+        Summary = pool.get('helpdesk.summary')
         attachments = [a for h in helpdesks for a in h.attachments]
         Attachment.delete(attachments)
+        old_values = Summary.get_values([h.id for h in helpdesks])
         super(Helpdesk, cls).delete(helpdesks)
+        Summary.set_summary(old_values, [])
 
     @classmethod
     def copy(cls, helpdesks, default=None):
@@ -305,6 +908,11 @@ class Helpdesk(Workflow, ModelSQL, ModelView):
             default = {}
         default = default.copy()
         default['attachments'] = None
+        default.setdefault('unread_count', 0)
+        default.setdefault('attachment_count', 0)
+        default.setdefault('archived', False)
+        default.setdefault('archived_talks', None)
+        default.setdefault('archived_logs', None)
         return super(Helpdesk, cls).copy(helpdesks, default=default)
 
     # @classmethod
@@ -319,46 +927,46 @@ class Helpdesk(Workflow, ModelSQL, ModelView):
         Talk = pool.get('helpdesk.talk')
         User = pool.get('res.user')
         user = User(Transaction().user)
-        reads = []
         for helpdesk in helpdesks:
             if not helpdesk.message:
                 raise UserError(gettext('helpdesk.msg_no_message'))
 
-            talk = Talk()
-            talk.date = datetime.now()
-            talk.email = user.email or None
-            talk.helpdesk = helpdesk
-            talk.message = helpdesk.message
-            talk.message_id = helpdesk.message_id
-            talk.unread = False
-            talk.save()
-            for talk in helpdesk.talks:
-                if talk.unread:
-                    reads.append(talk)
-        if reads:
-            Talk.write(reads, {'unread': False})
+        now = datetime.now()
+        answered = cls.get_answered_talks(helpdesks)
+        talks = Talk.create([{
+                    'date': now,
+                    'email': user.email or None,
+                    'helpdesk': helpdesk.id,
+                    'message': helpdesk.message,
+                    'message_id': helpdesk.message_id,
+                    'unread': False,
+                    'parent': (answered[helpdesk.id].id
+                        if helpdesk.id in answered else None),
+                    } for helpdesk in helpdesks])
+        # Mark as read the talks of the helpdesks
+        cls.set_unread(helpdesks, 'unread', False)
+        return talks
 
     @classmethod
     def _log(cls, helpdesks, keyword):
-        pool = Pool()
-        User = pool.get('res.user')
-        Log = pool.get('helpdesk.log')
-        for helpdesk in helpdesks:
-            log = Log()
-            log.name = keyword
-            log.date = datetime.now()
-            log.user = User(Transaction().user)
-            log.helpdesk = helpdesk
-            log.save()
+        Log = Pool().get('helpdesk.log')
+        now = datetime.now()
+        Log.create([{
+                    'name': keyword,
+                    'date': now,
+                    'user': Transaction().user,
+                    'helpdesk': helpdesk.id,
+                    } for helpdesk in helpdesks])
 
     @classmethod
     @ModelView.button
     def add_reply(cls, helpdesks):
+        answered = cls.get_answered_talks(helpdesks)
         for helpdesk in helpdesks:
-            if helpdesk.talks:
-                message = helpdesk.talks[0].message
+            talk = answered.get(helpdesk.id)
+            if talk and talk.message:
                 cls.write([helpdesk], {
-                    'message': '> ' + message.replace('\n', '\n> '),
+                    'message': '> ' + talk.message.replace('\n', '\n> '),
                     })
 
     @classmethod
@@ -370,17 +978,61 @@ class Helpdesk(Workflow, ModelSQL, ModelView):
     @classmethod
     @ModelView.button
     def talk_email(cls, helpdesks):
+        Outbox = Pool().get('helpdesk.outbox')
         for helpdesk in helpdesks:
             if not helpdesk.email_from:
                 raise UserError(gettext('helpdesk.msg_no_email_from'))
             if not helpdesk.message:
                 raise UserError(gettext('helpdesk.msg_no_message'))
-        cls.send_email(helpdesks)  # Send email
-        cls._talk(helpdesks)
+        # Emails are queued in the outbox and delivered by the cron
+        emails = cls.get_emails(helpdesks)
+        cls.set_email_values(emails)
+        talks = cls._talk(helpdesks)
+        Outbox.queue(emails, talks)
         cls.write(helpdesks, {'message': None})
 
     @classmethod
     def send_email(cls, helpdesks):
+        'Send the helpdesk messages when the transaction is committed'
+        with IngestStats('send_email') as stats:
+            with stats.stage('prepare'):
+                emails = cls.get_emails(helpdesks)
+
+            # The emails of the same SMTP server are sent with one connection
+            # when the transaction is committed
+            datamanagers = {}
+            for helpdesk, server, from_, recipients, msg in emails:
+                with stats.stage('queue'):
+                    if server.id not in datamanagers:
+                        datamanagers[server.id] = Transaction().join(
+                            HelpdeskSMTPDataManager(server))
+                    sendmail_transactional(from_, recipients, msg,
+                        datamanager=datamanagers[server.id])
+                stats.count('messages')
+                stats.count('recipients', len(recipients))
+                stats.count('attachments', len(helpdesk.add_attachments))
+            with stats.stage('write'):
+                cls.set_email_values(emails)
+            stats.save()
+
+    @classmethod
+    def set_email_values(cls, emails):
+        'Write the message id of the emails sent to the helpdesks'
+        to_write = []
+        for helpdesk, server, from_, recipients, msg in emails:
+            vals = {}
+            vals['message_id'] = msg.get('Message-ID')
+            if helpdesk.add_attachments:
+                vals['add_attachments'] = [('remove',
+                    [x.id for x in helpdesk.add_attachments])]
+            to_write.extend(([helpdesk], vals))
+        if to_write:
+            cls.write(*to_write)
+
+    @classmethod
+    def get_emails(cls, helpdesks):
+        '''Return a list of (helpdesk, server, from, recipients, msg) with
+        the email of the message of each helpdesk'''
         pool = Pool()
         SMTP = pool.get('smtp.server')
         User = pool.get('res.user')
@@ -392,6 +1044,7 @@ class Helpdesk(Workflow, ModelSQL, ModelView):
         signature = ('\n\n--\n%s' % user.signature
             if user.signature else user.name)
 
+        result = []
         for helpdesk in helpdesks:
             server = getattr(helpdesk_configuration, 'smtp_%s' % helpdesk.kind,
                 None)
@@ -460,18 +1113,8 @@ class Helpdesk(Workflow, ModelSQL, ModelView):
                     'Content-Transfer-Encoding', 'base64')
                 msg.attach(attach)
 
-            datamanager = SMTPDataManager()
-            datamanager._server = server.get_smtp_server()
-            sendmail_transactional(from_, recipients, msg, datamanager=datamanager)
-
-            #  write helpdesk values
-            vals = {}
-            vals['message_id'] = msg.get('Message-ID')
-            if helpdesk.add_attachments:
-                vals['add_attachments'] = [('remove',
-                    [x.id for x in helpdesk.add_attachments])]
-            if vals:
-                cls.write([helpdesk], vals)
+            result.append((helpdesk, server, from_, recipients, msg))
+        return result
 
     @classmethod
     @ModelView.button
@@ -487,13 +1130,12 @@ class Helpdesk(Workflow, ModelSQL, ModelView):
     def open(cls, helpdesks):
         User = Pool().get('res.user')
         keyword = gettext('helpdesk.opened')
-        for helpdesk in helpdesks:
-            if not helpdesk.employee:
-                employee = User(Transaction().user).employee
-                if not employee:
-                    raise UserError(gettext('searching.msg_no_user'))
-
-                cls.write([helpdesk], {'employee': employee})
+        to_write = [h for h in helpdesks if not h.employee]
+        if to_write:
+            employee = User(Transaction().user).employee
+            if not employee:
+                raise UserError(gettext('searching.msg_no_user'))
+            cls.write(to_write, {'employee': employee.id})
         cls._log(helpdesks, keyword)
 
     @classmethod
@@ -501,6 +1143,7 @@ class Helpdesk(Workflow, ModelSQL, ModelView):
     @Workflow.transition('pending')
     def pending(cls, helpdesks):
         keyword = gettext('searching.pending')
+        cls.unarchive(helpdesks)
         cls._log(helpdesks, keyword)
 
     @classmethod
@@ -508,133 +1151,710 @@ class Helpdesk(Workflow, ModelSQL, ModelView):
     @Workflow.transition('draft')
     def draft(cls, helpdesks):
         keyword = gettext('searching.drafted')
+        cls.unarchive(helpdesks)
         cls._log(helpdesks, keyword)
 
+    @classmethod
+    def archive_done(cls):
+        'Archive the helpdesks done before the archive delay'
+        Configuration = Pool().get('helpdesk.configuration')
+        configuration = Configuration(1)
+        if not configuration.archive_delay:
+            return
+        date = datetime.now() - timedelta(days=configuration.archive_delay)
+        helpdesks = cls.search([
+                ('state', '=', 'done'),
+                ('archived', '=', False),
+                ['OR',
+                    ('closed_date', '<', date),
+                    [
+                        ('closed_date', '=', None),
+                        ('write_date', '<', date),
+                        ],
+                    ],
+                ], order=[('id', 'ASC')])
+        # Commit each slice to keep the transactions small
+        for sub_helpdesks in grouped_slice(helpdesks):
+            cls.archive(list(sub_helpdesks))
+            Transaction().commit()
+
+    @classmethod
+    def archive(cls, helpdesks):
+        'Move the talks and logs of the helpdesks to the archive tables'
+        pool = Pool()
+        HelpdeskTalk = pool.get('helpdesk.talk')
+        HelpdeskLog = pool.get('helpdesk.log')
+        TalkReference = pool.get('helpdesk.talk.reference')
+        TalkArchive = pool.get('helpdesk.talk.archive')
+        LogArchive = pool.get('helpdesk.log.archive')
+        talk = HelpdeskTalk.__table__()
+        log = HelpdeskLog.__table__()
+        reference = TalkReference.__table__()
+        cursor = Transaction().connection.cursor()
+
+        ids = [h.id for h in helpdesks if not h.archived]
+        for sub_ids in grouped_slice(ids):
+            sub_ids = list(sub_ids)
+            # The references lose their talk when it is deleted
+            cursor.execute(*reference.select(reference.talk,
+                    reference.reference,
+                    where=reduce_ids(reference.helpdesk, sub_ids)
+                    & (reference.talk != Null)))
+            talk_references = {}
+            for talk_id, value in cursor.fetchall():
+                talk_references.setdefault(talk_id, []).append(value)
+
+            cursor.execute(*talk.select(talk.id, talk.helpdesk, talk.date,
+                    talk.email, talk.message, talk.snippet, talk.unread,
+                    talk.message_id, talk.email_state, talk.parent,
+                    talk.path, talk.depth, talk.original_compressed,
+                    where=reduce_ids(talk.helpdesk, sub_ids)))
+            TalkArchive.create([{
+                        'helpdesk': row['helpdesk'],
+                        'talk_id': row['id'],
+                        'date': row['date'],
+                        'email': row['email'],
+                        'message_compressed': compress(row['message']),
+                        'snippet': row['snippet'],
+                        'unread': row['unread'],
+                        'message_id': row['message_id'],
+                        'email_state': row['email_state'],
+                        'parent_id': row['parent'],
+                        'path': row['path'],
+                        'depth': row['depth'],
+                        'original_compressed': (
+                            bytes(row['original_compressed'])
+                            if row['original_compressed'] is not None
+                            else None),
+                        'references': '\n'.join(
+                            talk_references.get(row['id'], [])) or None,
+                        } for row in cursor_dict(cursor)])
+
+            cursor.execute(*log.select(log.id, log.helpdesk, log.name,
+                    log.date, log.user,
+                    where=reduce_ids(log.helpdesk, sub_ids)))
+            LogArchive.create([{
+                        'helpdesk': row['helpdesk'],
+                        'log_id': row['id'],
+                        'name': row['name'],
+                        'date': row['date'],
+                        'user': row['user'],
+                        } for row in cursor_dict(cursor)])
+
+            cursor.execute(*talk.delete(
+                    where=reduce_ids(talk.helpdesk, sub_ids)))
+            cursor.execute(*log.delete(
+                    where=reduce_ids(log.helpdesk, sub_ids)))
+            cls.write(cls.browse(sub_ids), {'archived': True})
+            cls.update_unread_count(sub_ids)
+        clear_cache(HelpdeskTalk)
+        clear_cache(HelpdeskLog)
+        clear_cache(TalkReference)
+
+    @classmethod
+    def unarchive(cls, helpdesks):
+        'Move back the talks and logs of the helpdesks from the archive'
+        pool = Pool()
+        HelpdeskTalk = pool.get('helpdesk.talk')
+        HelpdeskLog = pool.get('helpdesk.log')
+        TalkReference = pool.get('helpdesk.talk.reference')
+        TalkArchive = pool.get('helpdesk.talk.archive')
+        LogArchive = pool.get('helpdesk.log.archive')
+        talk = HelpdeskTalk.__table__()
+        log = HelpdeskLog.__table__()
+        reference = TalkReference.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        ids = [h.id for h in helpdesks if h.archived]
+        for sub_ids in grouped_slice(ids):
+            sub_ids = list(sub_ids)
+            # The parents are restored before their replies
+            talk_archives = TalkArchive.search([
+                    ('helpdesk', 'in', sub_ids),
+                    ], order=[('talk_id', 'ASC')])
+            # Restore the talks with their ids to keep the relations
+            for sub_archives in grouped_slice(talk_archives):
+                sub_archives = list(sub_archives)
+                cursor.execute(*talk.insert([talk.id, talk.create_uid,
+                            talk.create_date, talk.helpdesk, talk.date,
+                            talk.email, talk.message, talk.snippet,
+                            talk.unread, talk.message_id, talk.email_state,
+                            talk.parent, talk.path, talk.depth,
+                            talk.original_compressed],
+                        [[a.talk_id, transaction.user, CurrentTimestamp(),
+                                a.helpdesk.id, a.date, a.email, a.message,
+                                a.snippet, a.unread, a.message_id,
+                                a.email_state, a.parent_id, a.path, a.depth,
+                                a.original_compressed]
+                            for a in sub_archives]))
+                for archive in sub_archives:
+                    if not archive.references:
+                        continue
+                    cursor.execute(*reference.update(
+                            [reference.talk], [archive.talk_id],
+                            where=(reference.helpdesk == archive.helpdesk.id)
+                            & (reference.talk == Null)
+                            & reference.reference.in_(
+                                archive.references.split('\n'))))
+
+            log_archives = LogArchive.search([
+                    ('helpdesk', 'in', sub_ids),
+                    ])
+            for sub_archives in grouped_slice(log_archives):
+                cursor.execute(*log.insert([log.id, log.create_uid,
+                            log.create_date, log.helpdesk, log.name,
+                            log.date, log.user],
+                        [[a.log_id, transaction.user, CurrentTimestamp(),
+                                a.helpdesk.id, a.name, a.date,
+                                a.user.id if a.user else None]
+                            for a in sub_archives]))
+
+            TalkArchive.delete(talk_archives)
+            LogArchive.delete(log_archives)
+            cls.write(cls.browse(sub_ids), {'archived': False})
+            cls.update_unread_count(sub_ids)
+        clear_cache(HelpdeskTalk)
+        clear_cache(HelpdeskLog)
+        clear_cache(TalkReference)
+
     @classmethod
     def getmail(cls, server, messages):
-        'Get messages and load in helpdesk talks'
+        '''Get messages and load in helpdesk talks
+
+        When the configuration has a chunk size, the messages are loaded and
+        committed by chunks. The messages of a failed chunk are loaded one
+        by one and the failed ones are quarantined. The current transaction
+        is committed before the first chunk and after each chunk, so the
+        caller must not rely on a rollback to undo the load.
+
+        The threads of the messages are locked while they are loaded, so
+        several workers can get mails at the same time.
+        '''
+        pool = Pool()
+        Configuration = pool.get('helpdesk.configuration')
+        Quarantine = pool.get('helpdesk.quarantine')
+        transaction = Transaction()
+
+        configuration = Configuration(1)
+        chunk_size = configuration.getmail_chunk_size
+        messages = list(reversed(messages))  # order older to new message
+        if not chunk_size:
+            cls._getmail(server, messages)
+            return
+
+        quarantined = Quarantine.get_quarantined(
+            {m.message_id for m in messages if m.message_id})
+        messages = [m for m in messages if m.message_id not in quarantined]
+        # Start the chunks with a new snapshot
+        transaction.commit()
+        chunks = [messages[i:i + chunk_size]
+            for i in range(0, len(messages), chunk_size)]
+        postponed = set()
+        while chunks:
+            chunk = chunks.pop(0)
+            try:
+                cls._getmail_commit(server, chunk)
+            except backend.DatabaseOperationalError:
+                # Load it at the end when its threads are still locked by
+                # another worker
+                if id(chunk) in postponed:
+                    raise
+                postponed.add(id(chunk))
+                chunks.append(chunk)
+                continue
+            except Exception:
+                transaction.rollback()
+                if len(chunk) == 1:
+                    cls._quarantine(server, chunk[0])
+                    continue
+                logger.warning('Load of %s emails failed, loading them one '
+                    'by one', len(chunk), exc_info=True)
+                for message in chunk:
+                    try:
+                        cls._getmail_commit(server, [message])
+                    except backend.DatabaseOperationalError:
+                        raise
+                    except Exception:
+                        transaction.rollback()
+                        cls._quarantine(server, message)
+
+    @classmethod
+    def _getmail_commit(cls, server, messages):
+        '''Load and commit the messages
+
+        The load is retried in a new transaction when the threads are locked
+        by another worker, so it sees the helpdesks created by the worker.
+        '''
+        transaction = Transaction()
+        retry = config.getint('database', 'retry')
+        for count in range(retry, -1, -1):
+            if count != retry:
+                time.sleep(0.02 * (retry - count))
+            try:
+                cls._getmail(server, messages)
+                transaction.commit()
+            except backend.DatabaseOperationalError:
+                transaction.rollback()
+                if count:
+                    continue
+                raise
+            break
+
+    @classmethod
+    def _quarantine(cls, server, message):
+        'Store the failed message with the current exception'
+        Quarantine = Pool().get('helpdesk.quarantine')
+        logger.warning('Quarantine email: %s', message.message_id,
+            exc_info=True)
+        Quarantine.quarantine(server, message, traceback.format_exc())
+        Transaction().commit()
+
+    @classmethod
+    def _getmail(cls, server, messages):
+        'Load in helpdesk talks the messages ordered from older to newer'
         pool = Pool()
         GetMail = pool.get('getmail.server')
         Helpdesk = pool.get('helpdesk')
         HelpdeskTalk = pool.get('helpdesk.talk')
+        TalkReference = pool.get('helpdesk.talk.reference')
+        Configuration = pool.get('helpdesk.configuration')
+
+        with IngestStats('getmail') as stats:
+            # Serialize the search and creation of the helpdesk of the threads
+            # with the other workers
+            with stats.stage('lock'):
+                cls.lock_threads(messages)
+            helpdesks_to_write = set()
+            attachments_cache = {}
+            configuration = Configuration(1)
+            blocked_digests = {b.digest
+                for b in configuration.blocked_attachments}
+            attachment_max_size = configuration.attachment_max_size
+            parties = {}
+            # Skip the messages already stored before parsing them
+            with stats.stage('duplicates'):
+                seen = cls.get_duplicate_messages(
+                    {m.message_id for m in messages if m.message_id})
+                new_messages = []
+                for message in messages:
+                    if message.message_id in seen:
+                        logger.info('Skip duplicated email: %s',
+                            message.message_id)
+                        stats.count('duplicates')
+                        continue
+                    if message.message_id:
+                        seen.add(message.message_id)
+                    new_messages.append(message)
+                messages = new_messages
+            with stats.stage('parse'):
+                messages_values = cls.parse_messages(messages,
+                    workers=configuration.getmail_workers,
+                    strip_reply=configuration.strip_reply)
+            # Search helpdesks related with all references of the batch at once
+            with stats.stage('threads'):
+                threads = cls.get_threads({reference
+                        for values in messages_values
+                        for reference in values['references']})
+                parents = cls.get_parent_talks({values['in_reply_to']
+                        for values in messages_values})
+            for message, values in zip(messages, messages_values):
+                stats.count('messages')
+                msgeid = values['message_id']
+                msgfrom = values['from']
+                msgcc = values['cc']
+                references = values['references']
+                msgsubject = values['subject']
+                msgdate = message.date
+                msgbody = values['body']
+                in_reply_to = values['in_reply_to']
+                logger.info('Process email: %s' % (msgeid))
+
+                # Search helpdesk by msg reference or msg in reply to. Threads
+                # also contains the helpdesks created in this batch
+                helpdesk = None
+                for reference in references:
+                    if reference in threads:
+                        helpdesk = threads[reference]
+                        break
+
+                # Helpdesk
+                if helpdesk and helpdesk.state in ('draft', 'done'):
+                    helpdesks_to_write.add(helpdesk)
+
+                if not helpdesk:
+                    with stats.stage('party'):
+                        party, address = cls.get_party_from_email(msgfrom,
+                            parties, lru=configuration.party_cache)
+                    with stats.stage('helpdesk'):
+                        helpdesk = Helpdesk()
+                        helpdesk.name = msgsubject
+                        helpdesk.email_from = msgfrom
+                        helpdesk.email_cc = msgcc
+                        helpdesk.party = party if party else None
+                        helpdesk.address = address if address else None
+                        helpdesk.message_id = msgeid
+                        helpdesk.kind = server.kind or 'generic'
+                        helpdesk.save()
+                    stats.count('helpdesks')
+
+                # Email files bigger than the size limit are not stored and
+                # a note is added to the talk message
+                files = []
+                if server.attachment:
+                    for attachment in message.attachments:
+                        try:
+                            fname = GetMail.get_filename(attachment[0])
+                        except:
+                            continue
+                        data = attachment[1]
+                        if (attachment_max_size and data
+                                and len(data) > attachment_max_size):
+                            msgbody += '\n\n' + gettext(
+                                'helpdesk.msg_attachment_max_size',
+                                name=fname, size=len(data))
+                            stats.count('skipped_attachments')
+                            continue
+                        files.append((fname, data))
+                        stats.count('attachments')
+                        stats.count('attachment_bytes', len(data or b''))
+
+                # Helpdesk talk
+                with stats.stage('talk'):
+                    helpdesk_talk = HelpdeskTalk()
+                    helpdesk_talk.date = GetMail.get_date(msgdate)
+                    helpdesk_talk.email = msgfrom
+                    helpdesk_talk.helpdesk = helpdesk
+                    helpdesk_talk.message = msgbody
+                    helpdesk_talk.original_compressed = compress(
+                        values['original'])
+                    helpdesk_talk.unread = True
+                    helpdesk_talk.message_id = msgeid
+                    parent = parents.get(in_reply_to)
+                    if parent and parent.helpdesk == helpdesk:
+                        helpdesk_talk.parent = parent
+                    # Keep all the message ids of the thread to relate replies
+                    # that only reference an intermediate message
+                    talk_references = list(dict.fromkeys(
+                            [r for r in [msgeid] + references if r]))
+                    helpdesk_talk.references = [
+                        TalkReference(helpdesk=helpdesk, reference=r)
+                        for r in talk_references]
+                    helpdesk_talk.save()
+                stats.count('talks')
+                for reference in talk_references:
+                    threads.setdefault(reference, helpdesk)
+                if msgeid:
+                    parents.setdefault(msgeid, helpdesk_talk)
+
+                # Attachments
+                if server.attachment:
+                    with stats.stage('attachments'):
+                        cls.save_email_attachments(helpdesk, files,
+                            blocked_digests, attachments_cache, msgeid=msgeid)
+
+            if helpdesks_to_write:
+                with stats.stage('state'):
+                    cls.unarchive(list(helpdesks_to_write))
+                    cls.write(list(helpdesks_to_write), {'state': 'pending'})
+            stats.save()
+
+    @classmethod
+    def save_email_attachments(cls, helpdesk, files, blocked, cache,
+            msgeid=None):
+        '''Save the email files (filename, data) as helpdesk attachments
+
+        - Attachment name is unique. Skip reapeat filename
+        - If there are another same filename, write
+        - Skip files with the same content of an attachment of the helpdesk
+          or with a blocked digest
+        - Skip files with an invalid filename or data, so they do not make
+          fail the creation of the other attachments
+        The cache keeps the attachments and digests of each helpdesk.
+        '''
+        pool = Pool()
         Attachment = pool.get('ir.attachment')
+        AttachmentDigest = pool.get('helpdesk.attachment.digest')
+
+        if helpdesk.id not in cache:
+            cache[helpdesk.id] = (
+                {a.name.lower(): a for a in Attachment.search([
+                            ('resource', '=', str(helpdesk)),
+                            ])},
+                {d.digest for d in AttachmentDigest.search([
+                            ('helpdesk', '=', helpdesk.id),
+                            ])})
+        names, digests = cache[helpdesk.id]
+
+        filenames = set()
+        to_create, to_write, file_digests = {}, [], {}
+        for fname, data in files:
+            if fname in filenames:
+                continue
+            filenames.add(fname)
 
-        new_talks = []
-        helpdesks_to_write = set()
-        for message in list(reversed(messages)): # order older to new message
-            to_ = message.to
-            if not to_:
-                to_ = message.delivered_to
-            msgeid = message.message_id
-            msgfrom = (parseaddr(re.sub('[,;]', '', message.from_addr))[1]
-                if message.from_addr else None)
-            msgcc = None
-            if message.cc:
-                ccs = re.findall(r'[\w\.-]+@[\w\.-]+', message.cc)
-                if ccs:
-                    msgcc = ",".join(ccs)
-            references = message.references
-            if references:
-                if ',' in references:  # Hotmail Reply References
-                    references = references.split(',')
-                elif '\r\n' in references:  # Gmail Replay References
-                    references = references.split('\r\n')
-                elif ' ' in references:  # Yahoo References
-                    references = references.split(' ')
-                else:
-                    references = [references]
-            if not references:
-                references = [msgeid]
-            if getattr(message, 'in_reply_to'):
-                references.append(message.in_reply_to)
-            msgsubject = message.title or 'Not subject'
-            msgdate = message.date
-            # not replace html2text an email string: "User <user@domain.com>"
-            msgbody = re.sub('<([^<]*@[^>]*)>', '\g<1>', message.body, re.M|re.I)
-            msgbody = html2text(msgbody.replace('\n', '<br>'))
-            logger.info('Process email: %s' % (msgeid))
-
-            # Search helpdesk by msg reference, msg in reply to or
-            # "description + email from"
-            helpdesk = None
-            talks_by_ref = HelpdeskTalk.search([
-                    ('message_id', 'in', references)
-                    ], limit=1)
-            if talks_by_ref:
-                helpdesk = talks_by_ref[0].helpdesk
-
-            # check if a new talk is related with recent helpdesk
-            if not helpdesk:
-                for new_talk in new_talks:
-                    if new_talk.message_id in references:
-                        helpdesk = new_talk.helpdesk
-                        break
+            if (not isinstance(fname, str) or not fname.strip()
+                    or '\x00' in fname):
+                logger.warning('Email Attachment: %s. Invalid filename %r'
+                    % (msgeid, fname))
+                continue
+            if not isinstance(data, (bytes, bytearray)):
+                logger.warning('Email Attachment: %s. Wrong data type of %s'
+                    % (msgeid, fname))
+                continue
+            digest = AttachmentDigest.get_digest(data)
+            if digest in blocked or digest in digests:
+                continue
+            key = fname.lower()
+            if key in names:
+                to_write.extend(([names[key]], {'data': data}))
+            elif key in to_create:
+                to_create[key]['data'] = data
+                digests.discard(file_digests[key])
+            else:
+                to_create[key] = {
+                    'name': fname,
+                    'resource': str(helpdesk),
+                    'type': 'data',
+                    'data': data,
+                    }
+            digests.add(digest)
+            file_digests[key] = digest
+
+        attachments = []
+        if to_write:
+            Attachment.write(*to_write)
+            for records in to_write[::2]:
+                attachments.extend(records)
+            old_digests = AttachmentDigest.search([
+                    ('attachment', 'in', [a.id for a in attachments]),
+                    ])
+            digests.difference_update(d.digest for d in old_digests)
+            AttachmentDigest.delete(old_digests)
+        if to_create:
+            for attachment in Attachment.create(list(to_create.values())):
+                names[attachment.name.lower()] = attachment
+                attachments.append(attachment)
+        if attachments:
+            AttachmentDigest.create([{
+                        'helpdesk': helpdesk.id,
+                        'attachment': a.id,
+                        'digest': file_digests[a.name.lower()],
+                        } for a in attachments])
 
-            # Helpdesk
-            if helpdesk and helpdesk.state in ('draft', 'done'):
-                helpdesks_to_write.add(helpdesk)
-
-            if not helpdesk:
-                party, address = GetMail.get_party_from_email(msgfrom)
-                helpdesk = Helpdesk()
-                helpdesk.name = msgsubject
-                helpdesk.email_from = msgfrom
-                helpdesk.email_cc = msgcc
-                helpdesk.party = party if party else None
-                helpdesk.address = address if address else None
-                helpdesk.message_id = msgeid
-                helpdesk.kind = server.kind if server.kind else 'generic'
-                helpdesk.save()
-
-            # Helpdesk talk
-            helpdesk_talk = HelpdeskTalk()
-            helpdesk_talk.date = GetMail.get_date(msgdate)
-            helpdesk_talk.email = msgfrom
-            helpdesk_talk.helpdesk = helpdesk
-            helpdesk_talk.message = msgbody
-            helpdesk_talk.unread = True
-            helpdesk_talk.message_id = msgeid
-            helpdesk_talk.save()
-            new_talks.append(helpdesk_talk)
-
-            # Attachments
-            if server.attachment:
-                # - Attachment name is unique. Skip reapeat filename
-                # - If there are another same filename, write
-                attachment_names = set()
-                for attachment in message.attachments:
-                    try:
-                        fname = GetMail.get_filename(attachment[0])
-                    except:
-                        continue
+    @classmethod
+    def parse_messages(cls, messages, workers=None, strip_reply=False):
+        '''Return the parse_message values of the email messages
+
+        The messages are parsed in a pool of worker processes when there
+        are more than one worker. With strip_reply, the quoted messages are
+        removed from the body.
+        '''
+        messages_values = [{
+                'message_id': message.message_id,
+                'from_addr': message.from_addr,
+                'cc': message.cc,
+                'references': message.references,
+                'in_reply_to': getattr(message, 'in_reply_to'),
+                'title': message.title,
+                'body': message.body,
+                'strip_reply': strip_reply,
+                } for message in messages]
+        if workers and workers > 1 and len(messages_values) > 1:
+            chunksize = max(1, len(messages_values) // (workers * 4))
+            try:
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    return list(executor.map(parse_message, messages_values,
+                            chunksize=chunksize))
+            except Exception:
+                logger.warning('Parallel parse of emails failed, '
+                    'parsing them serially', exc_info=True)
+        return [parse_message(values) for values in messages_values]
 
-                    if fname in attachment_names:
-                        continue
-                    attachment_names.add(fname)
-
-                    attatchs = Attachment.search([
-                            ('name', 'ilike', fname),
-                            ('resource', '=', '%s' % (helpdesk)),
-                            ])
-                    if attatchs:
-                        attach, = attatchs
-                    else:
-                        attach = Attachment()
-                        attach.name = fname
-                        attach.resource = '%s' % (helpdesk)
-                        attach.type = 'data'
-                    attach.data = attachment[1]
-                    try:
-                        attach.save()
-                    except TypeError as e:
-                        logging.getLogger('Helpdesk').warning(
-                            'Email Attachment: %s. %s' % (msgeid, e))
-                        continue
-                    except:
-                        continue
+    @classmethod
+    def get_party_from_email(cls, email, cache, lru=False):
+        '''Return the party and address of the email
+
+        The results, also when no party is found, are kept in the cache of
+        the batch and in the cross-batch cache when lru is set.
+        '''
+        pool = Pool()
+        GetMail = pool.get('getmail.server')
+        Party = pool.get('party.party')
+        Address = pool.get('party.address')
+
+        key = (email or '').strip().lower()
+        if key in cache:
+            return cache[key]
+        ids = cls._party_cache.get(key) if lru else None
+        if ids is not None:
+            party_id, address_id = ids
+            result = (Party(party_id) if party_id else None,
+                Address(address_id) if address_id else None)
+        else:
+            party, address = GetMail.get_party_from_email(email)
+            result = (party or None, address or None)
+            if lru:
+                cls._party_cache.set(key, tuple(r.id if r else None
+                        for r in result))
+        cache[key] = result
+        return result
+
+    @classmethod
+    def lock_threads(cls, messages):
+        '''Lock the threads of the messages until the end of the transaction
+
+        It uses an advisory lock on the thread root message id if the
+        database supports it, otherwise the helpdesk table is locked. It
+        raises DatabaseOperationalError when a thread is locked by another
+        transaction.
+        '''
+        transaction = Transaction()
+
+        roots = set()
+        for message in messages:
+            root = thread_root(message.references, message.message_id,
+                getattr(message, 'in_reply_to', None))
+            if root:
+                roots.add('%s:%s' % (cls.__name__, root))
+        if roots and not try_lock(roots):
+            transaction.database.lock(transaction.connection, cls._table)
+
+    @classmethod
+    def get_duplicate_messages(cls, message_ids):
+        '''Return the message ids already stored as a talk or an archived
+        talk
+
+        The talks are searched with their (message_id, helpdesk) index.
+        '''
+        pool = Pool()
+        HelpdeskTalk = pool.get('helpdesk.talk')
+        TalkArchive = pool.get('helpdesk.talk.archive')
+        cursor = Transaction().connection.cursor()
+
+        duplicates = set()
+        for sub_ids in grouped_slice([i for i in message_ids if i]):
+            sub_ids = list(sub_ids)
+            for Talk in [HelpdeskTalk, TalkArchive]:
+                talk = Talk.__table__()
+                cursor.execute(*talk.select(talk.message_id,
+                        where=talk.message_id.in_(sub_ids),
+                        group_by=[talk.message_id]))
+                duplicates.update(m for m, in cursor.fetchall())
+        return duplicates
 
-        if helpdesks_to_write:
-            cls.write(list(helpdesks_to_write), {'state': 'pending'})
+    @classmethod
+    def get_parent_talks(cls, message_ids):
+        'Return a dict of message id and its first talk'
+        HelpdeskTalk = Pool().get('helpdesk.talk')
+
+        message_ids = [m for m in message_ids if m]
+        parents = {}
+        for sub_ids in grouped_slice(message_ids):
+            talks = HelpdeskTalk.search([
+                    ('message_id', 'in', list(sub_ids)),
+                    ], order=[('id', 'ASC')])
+            for talk in talks:
+                parents.setdefault(talk.message_id, talk)
+        return parents
+
+    @classmethod
+    def get_answered_talks(cls, helpdesks):
+        'Return a dict of helpdesk id and its last talk not sent by the user'
+        pool = Pool()
+        HelpdeskTalk = pool.get('helpdesk.talk')
+        User = pool.get('res.user')
+        talk = HelpdeskTalk.__table__()
+        cursor = Transaction().connection.cursor()
+
+        email = User(Transaction().user).email
+        # Without email the talks of the user can not be told apart
+        where = Literal(True)
+        if email:
+            where &= (talk.email == Null) | (talk.email != email)
+        answered = {}
+        for sub_ids in grouped_slice([h.id for h in helpdesks]):
+            cursor.execute(*talk.select(talk.helpdesk, Max(talk.id),
+                    where=reduce_ids(talk.helpdesk, sub_ids) & where,
+                    group_by=[talk.helpdesk]))
+            answered.update(cursor.fetchall())
+        return {h: HelpdeskTalk(t) for h, t in answered.items()}
+
+    @classmethod
+    def get_threads(cls, references):
+        'Return a dict of message id and the helpdesk of its thread'
+        TalkReference = Pool().get('helpdesk.talk.reference')
+
+        references = [r for r in references if r]
+        threads = {}
+        for sub_references in grouped_slice(references):
+            talk_references = TalkReference.search([
+                    ('reference', 'in', list(sub_references)),
+                    ])
+            for talk_reference in talk_references:
+                threads.setdefault(talk_reference.reference,
+                    talk_reference.helpdesk)
+        return threads
+
+    @classmethod
+    def search_keyset(cls, domain, key=None, limit=100):
+        '''Return the ids of a page of helpdesks in the default order and the
+        key of the next page
+
+        The key is None for the first page and when there are no more pages.
+        The database seeks the next page with the order index instead of
+        skipping the previous rows like an offset.
+        '''
+        cursor = Transaction().connection.cursor()
+        order = [
+            ('priority', 'ASC NULLS LAST'),
+            ('date', 'DESC NULLS FIRST'),
+            ('id', 'DESC'),
+            ]
+        if key and key[1] is not None and backend.name == 'postgresql':
+            priority, date, id_ = key
+            query = cls.search(domain, order=order, limit=limit, query=True)
+            table = query.columns[0].expression.table
+            # PostgreSQL seeks the rows of a priority with a range scan of
+            # the index for a row comparison
+            same_priority = Row(table.date, table.id) < Row(date, id_)
+            if priority is None:
+                seek = (table.priority == Null) & same_priority
+            else:
+                seek = (((table.priority == priority) & same_priority)
+                    | (table.priority > priority)
+                    | (table.priority == Null))
+            query.where = (seek if query.where is None
+                else query.where & seek)
+            cursor.execute(*query)
+            helpdesks = cls.browse([i for i, in cursor.fetchall()])
+        elif key:
+            priority, date, id_ = key
+            if date is None:
+                same_priority = ['OR',
+                    [('date', '=', None), ('id', '<', id_)],
+                    ('date', '!=', None),
+                    ]
+            else:
+                same_priority = ['OR',
+                    ('date', '<', date),
+                    [('date', '=', date), ('id', '<', id_)],
+                    ]
+            if priority is None:
+                seek = [('priority', '=', None), same_priority]
+            else:
+                seek = ['OR',
+                    ('priority', '>', priority),
+                    ('priority', '=', None),
+                    [('priority', '=', priority), same_priority],
+                    ]
+            helpdesks = cls.search([domain, seek], order=order, limit=limit)
+        else:
+            helpdesks = cls.search(domain, order=order, limit=limit)
+        if not helpdesks or len(helpdesks) < limit:
+            return [h.id for h in helpdesks], None
+        last = helpdesks[-1]
+        return [h.id for h in helpdesks], [last.priority, last.date, last.id]
 
     @classmethod
     def search_rec_name(cls, name, clause):
@@ -643,11 +1863,16 @@ class Helpdesk(Workflow, ModelSQL, ModelView):
             bool_op = 'AND'
         else:
             bool_op = 'OR'
-        return [bool_op,
+        domain = [bool_op,
             domain,
             ('email_from',) + tuple(clause[1:]),
             ('email_cc',) + tuple(clause[1:]),
             ]
+        # Only the pattern searches match the words of the talks
+        if (clause[1] in {'like', 'ilike'} and isinstance(clause[2], str)
+                and Transaction().database.has_search_full_text()):
+            domain.append(('full_text',) + tuple(clause[1:]))
+        return domain
 
 
 class HelpdeskTalk(ModelSQL, ModelView):
@@ -657,12 +1882,36 @@ class HelpdeskTalk(ModelSQL, ModelView):
     date = fields.DateTime('Date', readonly=True)
     email = fields.Char('email')
     helpdesk = fields.Many2One('helpdesk', 'Helpdesk', required=True,
-        ondelete='CASCADE')
-    message = fields.Text('Message')
+        ondelete='CASCADE', select=True)
+    message = fields.Text('Message', loading='lazy')
+    snippet = fields.Text('Snippet', readonly=True)
     display_text = fields.Function(fields.Text('Display Text'),
         'get_display_text')
+    original = fields.Function(fields.Text('Original Message',
+            help='The received message with the quoted replies.'),
+        'get_original')
+    original_compressed = fields.Binary('Original Message Compressed',
+        readonly=True)
     unread = fields.Boolean('Unread')
     message_id = fields.Char('Message ID')
+    email_state = fields.Selection([
+            (None, ''),
+            ('pending', 'Pending'),
+            ('sent', 'Sent'),
+            ('failed', 'Failed'),
+            ], 'Email State', readonly=True)
+    references = fields.One2Many('helpdesk.talk.reference', 'talk',
+        'References', readonly=True)
+    parent = fields.Many2One('helpdesk.talk', 'Parent', readonly=True,
+        ondelete='SET NULL', select=True,
+        domain=[('helpdesk', '=', Eval('helpdesk'))],
+        depends=['helpdesk'],
+        help='The talk this one replies to.')
+    children = fields.One2Many('helpdesk.talk', 'parent', 'Replies',
+        readonly=True)
+    path = fields.Char('Path', readonly=True, select=True,
+        help='The ids of the ancestors and the talk.')
+    depth = fields.Integer('Depth', readonly=True)
 
     @classmethod
     def __setup__(cls):
@@ -671,65 +1920,271 @@ class HelpdeskTalk(ModelSQL, ModelView):
             ('id', 'DESC'),
             ]
 
+    @classmethod
+    def __register__(cls, module_name):
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        exist = backend.TableHandler.table_exist(cls._table)
+        if exist:
+            table_h = cls.__table_handler__(module_name)
+            fill_snippet = not table_h.column_exist('snippet')
+            fill_path = not table_h.column_exist('path')
+
+        super(HelpdeskTalk, cls).__register__(module_name)
+
+        # Migration from 6.0: fill path
+        if exist and fill_path:
+            id_ = Cast(table.id, cls.path.sql_type().base)
+            cursor.execute(*table.update([table.path, table.depth], [
+                        Concat(Concat('/', Substring(
+                                    Concat('0' * 10, id_),
+                                    CharLength(id_) + 1)), '/'),
+                        0]))
+
+        # Migration from 6.0: fill snippet
+        if exist and fill_snippet:
+            cursor.execute(*table.select(table.id,
+                    where=table.message != Null))
+            ids = [id_ for id_, in cursor.fetchall()]
+            # Load the messages and update the snippets by slices
+            for sub_ids in grouped_slice(ids, 100):
+                where = reduce_ids(table.id, sub_ids)
+                cursor.execute(*table.select(table.id, table.message,
+                        where=where))
+                snippet = Case(*((table.id == id_, cls.get_snippet(message))
+                        for id_, message in cursor.fetchall()))
+                cursor.execute(*table.update([table.snippet], [snippet],
+                        where=where))
+
+        table_h = cls.__table_handler__(module_name)
+        table_h.index_action(['message_id', 'helpdesk'], 'add')
+        if backend.name == 'postgresql':
+            # Index for the prefix search of the branches
+            cursor.execute('CREATE INDEX IF NOT EXISTS '
+                '"helpdesk_talk_path_pattern_index" ON "helpdesk_talk" '
+                '("path" varchar_pattern_ops)')
+
     @staticmethod
     def default_date():
         return datetime.now()
 
+    @staticmethod
+    def get_snippet(message):
+        'Return the first lines of the message'
+        lines = message.split('\n', 6) if message else []
+        return ('\n\t'.join(lines[:6]) + '...' if len(lines) > 6
+            else '\n\t'.join(lines))
+
     def truncate_data(self):
-        message = self.message and self.message.split('\n') or []
-        return ('\n\t'.join(message[:6]) + '...' if len(message) > 6
-            else '\n\t'.join(message))
+        return self.get_snippet(self.message)
+
+    @classmethod
+    def get_original(cls, talks, name):
+        return {t.id: (decompress(t.original_compressed)
+                if t.original_compressed else t.message) for t in talks}
 
-    def get_display_text(self, name=None):
+    @classmethod
+    def get_display_text(cls, talks, name):
         Company = Pool().get('company.company')
 
-        display = ''
-        if self.email:
-            display += self.email + ' '
-        date = self.date
-        if date:
-            if pytz and Transaction().context.get('company'):
-                company = Company(Transaction().context['company'])
-                if company.timezone:
-                    czone = pytz.timezone(company.timezone)
-                    lzone = dateutil.tz.tzlocal()
+        company_id = Transaction().context.get('company')
+        czone = lzone = None
+        if pytz and company_id:
+            company = Company(company_id)
+            if company.timezone:
+                czone = pytz.timezone(company.timezone)
+                lzone = dateutil.tz.tzlocal()
+
+        result = {}
+        for talk in talks:
+            display = ''
+            if talk.email:
+                display += talk.email + ' '
+            date = talk.date
+            if date:
+                if czone:
                     date = date.replace(tzinfo=lzone).astimezone(czone)
-            display += '(' + str(date) + ')'
-        display += ':\n' + self.truncate_data()
-        return display
+                display += '(' + str(date) + ')'
+            display += ':\n' + (talk.snippet or '')
+            result[talk.id] = display
+        return result
 
     @classmethod
     def create(cls, vlist):
         Helpdesk = Pool().get('helpdesk')
 
-        now = datetime.now()
-
+        vlist = [v.copy() for v in vlist]
+        for values in vlist:
+            if 'message' in values:
+                values['snippet'] = cls.get_snippet(values['message'])
+            if values.get('message_id') and not values.get('references'):
+                values['references'] = [('create', [{
+                                'helpdesk': values.get('helpdesk'),
+                                'reference': values['message_id'],
+                                }])]
         talks = super(HelpdeskTalk, cls).create(vlist)
-        helpdesks = [t.helpdesk for t in talks]
+        cls.set_path(talks)
+        helpdesk_ids = {t.helpdesk.id for t in talks}
 
-        if helpdesks:
-            Helpdesk.write(helpdesks, {
-                'last_talk': now,
-                })
+        if helpdesk_ids:
+            cls.set_last_talk(helpdesk_ids)
+            Helpdesk.set_full_text(talks=talks)
+            Helpdesk.update_unread_count(list(helpdesk_ids))
         return talks
 
     @classmethod
     def write(cls, *args):
         Helpdesk = Pool().get('helpdesk')
 
-        helpdesks = []
-        now = datetime.now()
-
-        super(HelpdeskTalk, cls).write(*args)
+        args = list(args)
+        for i in range(1, len(args), 2):
+            if 'message' in args[i]:
+                args[i] = args[i].copy()
+                args[i]['snippet'] = cls.get_snippet(args[i]['message'])
 
+        last_talk_ids = set()
+        unread_ids = set()
+        full_text_ids = set()
         actions = iter(args)
         for talks, values in zip(actions, actions):
-            helpdesks = [t.helpdesk for t in talks]
+            if not {'date', 'unread', 'helpdesk', 'message'} & set(values):
+                continue
+            helpdesk_ids = {t.helpdesk.id for t in talks}
+            if values.get('helpdesk'):
+                helpdesk_ids.add(values['helpdesk'])
+            if 'date' in values or 'helpdesk' in values:
+                last_talk_ids |= helpdesk_ids
+            if 'unread' in values or 'helpdesk' in values:
+                unread_ids |= helpdesk_ids
+            if 'message' in values or 'helpdesk' in values:
+                full_text_ids |= helpdesk_ids
+
+        path_talks = []
+        actions = iter(args)
+        for talks, values in zip(actions, actions):
+            if 'parent' in values:
+                path_talks.extend(talks)
 
-        if helpdesks:
-            Helpdesk.write(helpdesks, {
-                'last_talk': now,
-                })
+        super(HelpdeskTalk, cls).write(*args)
+
+        if path_talks:
+            # Move the branches of the talks with their new parent
+            cls.set_path(cls.search(['OR'] + [
+                        ('path', 'like', t.path + '%')
+                        for t in path_talks if t.path],
+                    order=[('path', 'ASC')]))
+        if last_talk_ids:
+            cls.set_last_talk(last_talk_ids)
+        if full_text_ids:
+            Helpdesk.set_full_text(full_text_ids)
+        if unread_ids:
+            Helpdesk.update_unread_count(list(unread_ids))
+
+    @classmethod
+    def copy(cls, talks, default=None):
+        if default is None:
+            default = {}
+        default = default.copy()
+        default.setdefault('parent', None)
+        default.setdefault('children', None)
+        return super(HelpdeskTalk, cls).copy(talks, default=default)
+
+    @classmethod
+    def set_path(cls, talks):
+        '''Set the path and the depth of the talks from their parent
+
+        The parents must be before their children.
+        '''
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        paths = {}
+        for talk in talks:
+            parent = talk.parent
+            if parent and parent.id in paths:
+                parent_path, parent_depth = paths[parent.id]
+            elif parent and parent.path:
+                parent_path, parent_depth = parent.path, parent.depth or 0
+            else:
+                parent_path, parent_depth = '/', -1
+            paths[talk.id] = ('%s%010d/' % (parent_path, talk.id),
+                parent_depth + 1)
+        # Update the talks of each slice with one query
+        for sub_ids in grouped_slice(list(paths), 100):
+            sub_ids = list(sub_ids)
+            path = Case(*((table.id == i, paths[i][0]) for i in sub_ids))
+            depth = Case(*((table.id == i, paths[i][1]) for i in sub_ids))
+            cursor.execute(*table.update([table.path, table.depth],
+                    [path, depth], where=reduce_ids(table.id, sub_ids)))
+        clear_cache(cls, list(paths))
+
+    @classmethod
+    def get_tree(cls, helpdesk):
+        'Return the talks of the helpdesk in the order of the thread tree'
+        return cls.search([
+                ('helpdesk', '=', helpdesk.id),
+                ], order=[('path', 'ASC'), ('id', 'ASC')])
+
+    def get_branch(self):
+        'Return the ancestors, the talk and its replies in tree order'
+        if not self.path:
+            return [self]
+        ancestors = [int(i) for i in self.path.strip('/').split('/')]
+        return self.search(['OR',
+                ('id', 'in', ancestors),
+                ('path', 'like', self.path + '%'),
+                ], order=[('path', 'ASC'), ('id', 'ASC')])
+
+    @staticmethod
+    def set_last_talk(helpdesk_ids):
+        'Defer the update of the last talk of the helpdesks to the commit'
+        datamanager = Transaction().join(LastTalkDataManager())
+        datamanager.ids.update(helpdesk_ids)
+
+    @classmethod
+    def delete(cls, talks):
+        Helpdesk = Pool().get('helpdesk')
+
+        helpdesk_ids = {t.helpdesk.id for t in talks}
+        unread_ids = {t.helpdesk.id for t in talks if t.unread}
+
+        super(HelpdeskTalk, cls).delete(talks)
+
+        if helpdesk_ids:
+            Helpdesk.set_full_text(helpdesk_ids)
+        if unread_ids:
+            Helpdesk.update_unread_count(list(unread_ids))
+
+
+class HelpdeskTalkReference(ModelSQL):
+    'Helpdesk Talk Reference'
+    __name__ = 'helpdesk.talk.reference'
+    helpdesk = fields.Many2One('helpdesk', 'Helpdesk', required=True,
+        ondelete='CASCADE', select=True)
+    talk = fields.Many2One('helpdesk.talk', 'Talk', ondelete='SET NULL',
+        select=True)
+    reference = fields.Char('Reference', required=True, select=True,
+        help='Message-ID, References or In-Reply-To value of the talk.')
+
+    @classmethod
+    def __register__(cls, module_name):
+        pool = Pool()
+        HelpdeskTalk = pool.get('helpdesk.talk')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        talk = HelpdeskTalk.__table__()
+        exist = backend.TableHandler.table_exist(cls._table)
+
+        super(HelpdeskTalkReference, cls).__register__(module_name)
+
+        # Migration from 6.0: fill references with the talk message ids
+        if not exist:
+            cursor.execute(*table.insert(
+                    [table.create_uid, table.create_date, table.helpdesk,
+                        table.talk, table.reference],
+                    talk.select(talk.create_uid, talk.create_date,
+                        talk.helpdesk, talk.id, talk.message_id,
+                        where=talk.message_id != Null)))
 
 
 class HelpdeskLog(ModelSQL, ModelView):
@@ -761,3 +2216,25 @@ class HelpdeskAttachment(ModelSQL):
         select=True, required=True)
     attachment = fields.Many2One('ir.attachment', 'Attachment',
         ondelete='RESTRICT', select=True, required=True)
+
+
+class HelpdeskAttachmentDigest(ModelSQL):
+    'Helpdesk Attachment Digest'
+    __name__ = 'helpdesk.attachment.digest'
+    helpdesk = fields.Many2One('helpdesk', 'Helpdesk', required=True,
+        ondelete='CASCADE', select=True)
+    attachment = fields.Many2One('ir.attachment', 'Attachment',
+        required=True, ondelete='CASCADE', select=True)
+    digest = fields.Char('Digest', required=True, select=True)
+
+    @classmethod
+    def __register__(cls, module_name):
+        super(HelpdeskAttachmentDigest, cls).__register__(module_name)
+
+        table_h = cls.__table_handler__(module_name)
+        table_h.index_action(['helpdesk', 'digest'], 'add')
+
+    @staticmethod
+    def get_digest(data):
+        'Return the digest of the attachment data'
+        return hashlib.sha256(data).hexdigest()
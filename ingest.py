@@ -0,0 +1,215 @@
+# This file is part of the helpdesk module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import logging
+import math
+import threading
+import time
+
+from trytond import backend
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.pool import Pool, PoolMeta
+
+__all__ = ['HelpdeskIngestStat', 'HelpdeskIngestStatStage', 'Cron']
+
+logger = logging.getLogger(__name__)
+
+
+def percentile(values, percent):
+    'Return the nearest-rank percentile of the sorted values'
+    if not values:
+        return None
+    index = max(math.ceil(percent / 100 * len(values)) - 1, 0)
+    return values[index]
+
+
+class QueryCounter(logging.Handler):
+    '''Count the SQL queries logged by the database backend
+
+    The backends only log the queries when the debug level is enabled, so
+    the queries are not counted otherwise. Only the queries of the thread
+    that created the counter are counted.
+    '''
+
+    def __init__(self):
+        super(QueryCounter, self).__init__(logging.DEBUG)
+        self.count = 0
+        self.started = False
+        self.thread = threading.get_ident()
+        self.logger = logging.getLogger(
+            'trytond.backend.%s.database' % backend.name)
+
+    def emit(self, record):
+        if record.thread == self.thread:
+            self.count += 1
+
+    def start(self):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.addHandler(self)
+            self.started = True
+
+    def stop(self):
+        'Remove the handler and return the count or None when not started'
+        self.logger.removeHandler(self)
+        if self.started:
+            return self.count
+
+
+class IngestStats(object):
+    '''Measure the time of the stages and the counters of a run
+
+    It is used as a context manager, so the queries are no more counted when
+    the run fails before saving the statistics.
+    '''
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.date = datetime.now()
+        self.durations = defaultdict(list)
+        self.counters = defaultdict(int)
+        self.queries = QueryCounter()
+        self.start = time.perf_counter()
+
+    def __enter__(self):
+        self.queries.start()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.queries.stop()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[name].append(time.perf_counter() - start)
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    def save(self):
+        'Log the statistics of the run and store them'
+        Stat = Pool().get('helpdesk.ingest.stat')
+
+        duration = time.perf_counter() - self.start
+        queries = self.queries.stop()
+        messages = self.counters['messages']
+        stages = []
+        for name, durations in self.durations.items():
+            durations = sorted(durations)
+            stages.append({
+                    'name': name,
+                    'count': len(durations),
+                    'total': sum(durations),
+                    'p50': percentile(durations, 50),
+                    'p90': percentile(durations, 90),
+                    'p99': percentile(durations, 99),
+                    'max': durations[-1],
+                    })
+        values = {
+            'kind': self.kind,
+            'date': self.date,
+            'duration': duration,
+            'messages': messages,
+            'messages_per_second': (messages / duration
+                if duration else None),
+            'queries': queries,
+            'stages': [('create', stages)],
+            }
+        for name in Stat.counter_names():
+            values[name] = self.counters[name]
+
+        logger.info('%s: %s messages in %.3fs (%s queries) %s', self.kind,
+            messages, duration, queries if queries is not None else '-',
+            ', '.join('%s=%s' % (n, self.counters[n])
+                for n in sorted(self.counters) if n != 'messages'))
+        for stage in stages:
+            logger.info('%s stage %s: count=%s total=%.3fs p50=%.4fs '
+                'p90=%.4fs p99=%.4fs max=%.4fs', self.kind, stage['name'],
+                stage['count'], stage['total'], stage['p50'], stage['p90'],
+                stage['p99'], stage['max'])
+        stat, = Stat.create([values])
+        return stat
+
+
+class HelpdeskIngestStat(ModelSQL, ModelView):
+    'Helpdesk Ingest Statistic'
+    __name__ = 'helpdesk.ingest.stat'
+    kind = fields.Selection([
+            ('getmail', 'Get Mail'),
+            ('send_email', 'Send Email'),
+            ], 'Kind', required=True, readonly=True)
+    date = fields.DateTime('Date', readonly=True)
+    duration = fields.Float('Duration', digits=(16, 6), readonly=True,
+        help='Seconds of the run.')
+    messages = fields.Integer('Messages', readonly=True)
+    messages_per_second = fields.Float('Messages per Second', digits=(16, 2),
+        readonly=True)
+    queries = fields.Integer('Queries', readonly=True,
+        help='Only counted when the SQL queries are logged.')
+    helpdesks = fields.Integer('Helpdesks', readonly=True)
+    talks = fields.Integer('Talks', readonly=True)
+    attachments = fields.Integer('Attachments', readonly=True)
+    attachment_bytes = fields.Integer('Attachment Bytes', readonly=True)
+    skipped_attachments = fields.Integer('Skipped Attachments', readonly=True,
+        help='Attachments bigger than the maximum size.')
+    recipients = fields.Integer('Recipients', readonly=True)
+    duplicates = fields.Integer('Duplicates', readonly=True,
+        help='Messages skipped because they were already stored.')
+    stages = fields.One2Many('helpdesk.ingest.stat.stage', 'stat', 'Stages',
+        readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(HelpdeskIngestStat, cls).__setup__()
+        cls._order = [
+            ('date', 'DESC'),
+            ('id', 'DESC'),
+            ]
+
+    @staticmethod
+    def counter_names():
+        'Return the names of the counter fields'
+        return ['helpdesks', 'talks', 'attachments', 'attachment_bytes',
+            'skipped_attachments', 'recipients', 'duplicates']
+
+    @classmethod
+    def purge(cls):
+        'Delete the statistics older than the retention of the configuration'
+        Configuration = Pool().get('helpdesk.configuration')
+
+        retention = Configuration(1).ingest_stat_retention
+        if not retention:
+            return
+        cls.delete(cls.search([
+                    ('date', '<', datetime.now() - timedelta(days=retention)),
+                    ]))
+
+
+class HelpdeskIngestStatStage(ModelSQL, ModelView):
+    'Helpdesk Ingest Statistic Stage'
+    __name__ = 'helpdesk.ingest.stat.stage'
+    stat = fields.Many2One('helpdesk.ingest.stat', 'Statistic',
+        required=True, ondelete='CASCADE', select=True)
+    name = fields.Char('Stage', readonly=True)
+    count = fields.Integer('Count', readonly=True)
+    total = fields.Float('Total', digits=(16, 6), readonly=True)
+    p50 = fields.Float('50th Percentile', digits=(16, 6), readonly=True)
+    p90 = fields.Float('90th Percentile', digits=(16, 6), readonly=True)
+    p99 = fields.Float('99th Percentile', digits=(16, 6), readonly=True)
+    max = fields.Float('Maximum', digits=(16, 6), readonly=True)
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super(Cron, cls).__setup__()
+        cls.method.selection.append(
+            ('helpdesk.ingest.stat|purge', 'Purge Helpdesk Ingest Statistics'))
@@ -0,0 +1,252 @@
+# This file is part of the helpdesk module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from datetime import datetime, timedelta
+from email import message_from_string
+import logging
+
+from trytond import backend
+from trytond.i18n import gettext
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.pool import Pool, PoolMeta
+from trytond.pyson import Eval
+from trytond.sendmail import sendmail
+from trytond.transaction import Transaction
+
+from .helpdesk import try_lock
+
+__all__ = ['HelpdeskOutbox', 'Cron']
+
+logger = logging.getLogger(__name__)
+
+# Time after which a delivery that did not record its result is interrupted
+SENDING_TIMEOUT = timedelta(hours=1)
+
+
+class HelpdeskOutbox(ModelSQL, ModelView):
+    'Helpdesk Outbox'
+    __name__ = 'helpdesk.outbox'
+    helpdesk = fields.Many2One('helpdesk', 'Helpdesk', required=True,
+        ondelete='CASCADE', select=True, readonly=True)
+    talk = fields.Many2One('helpdesk.talk', 'Talk', ondelete='SET NULL',
+        readonly=True)
+    server = fields.Many2One('smtp.server', 'SMTP Server', required=True,
+        ondelete='RESTRICT', readonly=True)
+    from_ = fields.Char('From', readonly=True)
+    recipients = fields.Char('Recipients', readonly=True)
+    message = fields.Text('Message', readonly=True)
+    message_id = fields.Char('Message ID', readonly=True)
+    state = fields.Selection([
+            ('pending', 'Pending'),
+            ('sending', 'Sending'),
+            ('sent', 'Sent'),
+            ('failed', 'Failed'),
+            ], 'State', required=True, readonly=True)
+    attempts = fields.Integer('Attempts', readonly=True)
+    next_attempt = fields.DateTime('Next Attempt', readonly=True)
+    sent_date = fields.DateTime('Sent Date', readonly=True)
+    error = fields.Text('Error', readonly=True,
+        states={
+            'invisible': ~Eval('error'),
+            },
+        depends=['error'])
+
+    @classmethod
+    def __setup__(cls):
+        super(HelpdeskOutbox, cls).__setup__()
+        cls._order = [
+            ('id', 'DESC'),
+            ]
+        cls._buttons.update({
+                'retry': {
+                    'invisible': Eval('state') != 'failed',
+                    'depends': ['state'],
+                    },
+                })
+
+    @classmethod
+    def __register__(cls, module_name):
+        super(HelpdeskOutbox, cls).__register__(module_name)
+
+        table_h = cls.__table_handler__(module_name)
+        table_h.index_action(['state', 'server', 'next_attempt'], 'add')
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @staticmethod
+    def default_attempts():
+        return 0
+
+    @classmethod
+    def queue(cls, emails, talks):
+        '''Queue the emails (helpdesk, server, from, recipients, msg) and
+        relate them with the talks of the same helpdesk'''
+        HelpdeskTalk = Pool().get('helpdesk.talk')
+
+        talks = {t.helpdesk.id: t for t in talks}
+        outboxes = cls.create([{
+                    'helpdesk': helpdesk.id,
+                    'talk': (talks[helpdesk.id].id
+                        if helpdesk.id in talks else None),
+                    'server': server.id,
+                    'from_': from_,
+                    'recipients': ','.join(recipients),
+                    'message': msg.as_string(),
+                    'message_id': msg.get('Message-ID'),
+                    } for helpdesk, server, from_, recipients, msg in emails])
+        if talks:
+            HelpdeskTalk.write(list(talks.values()), {
+                    'email_state': 'pending',
+                    })
+        return outboxes
+
+    @classmethod
+    @ModelView.button
+    def retry(cls, outboxes):
+        cls.write(outboxes, {
+                'state': 'pending',
+                'attempts': 0,
+                'next_attempt': None,
+                'error': None,
+                })
+
+    @classmethod
+    def deliver(cls):
+        '''Deliver the pending emails
+
+        Each SMTP server is delivered by only one worker at the same time
+        with one connection per batch. Failed emails are retried with an
+        exponential backoff.
+
+        The server is locked by the current transaction until the end of
+        the delivery, while the batch is marked as sending, sent and recorded
+        in new transactions. So the emails are never sent twice. The emails
+        left sending by an interrupted delivery are marked as failed to be
+        checked and retried manually.
+        '''
+        pool = Pool()
+        SMTP = pool.get('smtp.server')
+        Configuration = pool.get('helpdesk.configuration')
+        transaction = Transaction()
+        database = transaction.database
+
+        configuration = Configuration(1)
+        batch_size = configuration.outbox_batch_size or None
+
+        interrupted = cls.search([
+                ('state', '=', 'sending'),
+                ('write_date', '<', datetime.now() - SENDING_TIMEOUT),
+                ])
+        if interrupted:
+            cls.write(interrupted, {
+                    'state': 'failed',
+                    'error': gettext('helpdesk.msg_outbox_interrupted'),
+                    })
+            transaction.commit()
+
+        servers = SMTP.search([])
+        for server in servers:
+            now = datetime.now()
+            try:
+                if not try_lock(['%s,%s' % (cls.__name__, server.id)]):
+                    # The new transactions must still write the outboxes
+                    database.lock(transaction.connection, SMTP._table)
+            except backend.DatabaseOperationalError:
+                # Delivered by another worker
+                transaction.rollback()
+                continue
+            # The new transactions see the emails recorded by the previous
+            # holder of the lock
+            with transaction.new_transaction():
+                outboxes = cls.search([
+                        ('state', '=', 'pending'),
+                        ('server', '=', server.id),
+                        ['OR',
+                            ('next_attempt', '=', None),
+                            ('next_attempt', '<=', now),
+                            ],
+                        ], order=[('id', 'ASC')], limit=batch_size)
+                ids = [o.id for o in outboxes]
+                cls.write(outboxes, {'state': 'sending'})
+            if ids:
+                with transaction.new_transaction():
+                    cls.send(SMTP(server.id), cls.browse(ids),
+                        Configuration(1))
+            # Release the lock of the server
+            transaction.commit()
+
+    @classmethod
+    def send(cls, server, outboxes, configuration):
+        'Send the outbox emails with one connection to the server'
+        HelpdeskTalk = Pool().get('helpdesk.talk')
+
+        max_attempts = configuration.outbox_max_attempts or 1
+        retry_delay = configuration.outbox_retry_delay or 0
+        now = datetime.now()
+
+        try:
+            smtp_server = server.get_smtp_server()
+        except Exception as e:
+            logger.warning('Connection to SMTP server %s failed: %s',
+                server.rec_name, e)
+            smtp_server = None
+            connection_error = str(e)
+
+        to_write, talks = [], {'sent': [], 'failed': []}
+        for outbox in outboxes:
+            error = None
+            if smtp_server:
+                try:
+                    sendmail(outbox.from_, outbox.recipients.split(','),
+                        message_from_string(outbox.message),
+                        server=smtp_server, strict=True)
+                except Exception as e:
+                    error = str(e)
+            else:
+                error = connection_error
+
+            attempts = outbox.attempts + 1
+            if not error:
+                values = {
+                    'state': 'sent',
+                    'sent_date': now,
+                    'error': None,
+                    }
+            elif attempts >= max_attempts:
+                values = {
+                    'state': 'failed',
+                    'error': error,
+                    }
+            else:
+                values = {
+                    'state': 'pending',
+                    'next_attempt': now + timedelta(
+                        seconds=retry_delay * 2 ** (attempts - 1)),
+                    'error': error,
+                    }
+            values['attempts'] = attempts
+            to_write.extend(([outbox], values))
+            if outbox.talk and values.get('state') in talks:
+                talks[values['state']].append(outbox.talk)
+        if smtp_server:
+            try:
+                smtp_server.quit()
+            except Exception:
+                pass
+
+        cls.write(*to_write)
+        for state, state_talks in talks.items():
+            if state_talks:
+                HelpdeskTalk.write(state_talks, {'email_state': state})
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super(Cron, cls).__setup__()
+        cls.method.selection.append(
+            ('helpdesk.outbox|deliver', 'Deliver Helpdesk Emails'))
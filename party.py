@@ -0,0 +1,39 @@
+# This file is part of the helpdesk module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.pool import Pool, PoolMeta
+
+__all__ = ['Party', 'ContactMechanism']
+
+
+class Party(metaclass=PoolMeta):
+    __name__ = 'party.party'
+
+    @classmethod
+    def delete(cls, parties):
+        Helpdesk = Pool().get('helpdesk')
+        super(Party, cls).delete(parties)
+        Helpdesk._party_cache.clear()
+
+
+class ContactMechanism(metaclass=PoolMeta):
+    __name__ = 'party.contact_mechanism'
+
+    @classmethod
+    def create(cls, vlist):
+        Helpdesk = Pool().get('helpdesk')
+        mechanisms = super(ContactMechanism, cls).create(vlist)
+        Helpdesk._party_cache.clear()
+        return mechanisms
+
+    @classmethod
+    def write(cls, *args):
+        Helpdesk = Pool().get('helpdesk')
+        super(ContactMechanism, cls).write(*args)
+        Helpdesk._party_cache.clear()
+
+    @classmethod
+    def delete(cls, mechanisms):
+        Helpdesk = Pool().get('helpdesk')
+        super(ContactMechanism, cls).delete(mechanisms)
+        Helpdesk._party_cache.clear()
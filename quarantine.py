@@ -0,0 +1,62 @@
+# This file is part of the helpdesk module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.tools import grouped_slice
+
+__all__ = ['HelpdeskQuarantine']
+
+
+class HelpdeskQuarantine(ModelSQL, ModelView):
+    'Helpdesk Quarantine'
+    __name__ = 'helpdesk.quarantine'
+    server = fields.Char('Server', readonly=True)
+    message_id = fields.Char('Message ID', readonly=True, select=True)
+    from_ = fields.Char('From', readonly=True)
+    cc = fields.Char('CC', readonly=True)
+    subject = fields.Char('Subject', readonly=True)
+    date = fields.Char('Date', readonly=True)
+    references = fields.Text('References', readonly=True)
+    in_reply_to = fields.Char('In Reply To', readonly=True)
+    body = fields.Text('Body', readonly=True)
+    attachments = fields.Integer('Attachments', readonly=True)
+    error = fields.Text('Error', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(HelpdeskQuarantine, cls).__setup__()
+        cls._order = [
+            ('id', 'DESC'),
+            ]
+
+    @classmethod
+    def quarantine(cls, server, message, error):
+        'Store the email message that failed to load with the error'
+        quarantine, = cls.create([{
+                    'server': getattr(server, 'rec_name', None),
+                    'message_id': message.message_id,
+                    'from_': message.from_addr,
+                    'cc': message.cc,
+                    'subject': message.title,
+                    'date': str(message.date) if message.date else None,
+                    'references': message.references,
+                    'in_reply_to': getattr(message, 'in_reply_to', None),
+                    'body': message.body,
+                    'attachments': len(getattr(message, 'attachments', None)
+                        or []),
+                    'error': error,
+                    }])
+        return quarantine
+
+    @classmethod
+    def get_quarantined(cls, message_ids):
+        '''Return the message ids in quarantine
+
+        They are not loaded again until their quarantine is deleted.
+        '''
+        quarantined = set()
+        for sub_ids in grouped_slice([m for m in message_ids if m]):
+            quarantined.update(q.message_id for q in cls.search([
+                        ('message_id', 'in', list(sub_ids)),
+                        ]))
+        return quarantined
@@ -0,0 +1,213 @@
+# This file is part of the helpdesk module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from sql import Literal, Null
+from sql.aggregate import Count, Min, Sum
+from sql.conditionals import Case, Coalesce
+
+from trytond import backend
+from trytond.model import ModelSQL, fields
+from trytond.pool import Pool, PoolMeta
+from trytond.rpc import RPC
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
+
+from .helpdesk import LastTalkDataManager, clear_cache
+
+__all__ = ['HelpdeskSummary', 'Cron']
+
+
+class SummaryDataManager(LastTalkDataManager):
+    '''Apply the summary deltas of the changed helpdesks once per transaction
+
+    The deltas are added before the commit of the connection, so the
+    counters are committed or rolled back with the helpdesks.
+    '''
+
+    def __init__(self):
+        self.deltas = {}
+
+    def commit(self, trans):
+        deltas = {k: v for k, v in self.deltas.items() if any(v)}
+        if deltas:
+            Summary = Pool().get('helpdesk.summary')
+            Summary.apply_deltas(deltas)
+
+    def _finish(self):
+        self.deltas = {}
+
+
+class HelpdeskSummary(ModelSQL):
+    '''Helpdesk Summary
+
+    The counters are updated with the deltas of the changed helpdesks in
+    their transaction. A key may have several rows when concurrent
+    transactions insert it, the counters are their sum and the daily cron
+    merges them.
+    '''
+    __name__ = 'helpdesk.summary'
+    employee = fields.Many2One('company.employee', 'Employee',
+        ondelete='CASCADE', select=True)
+    kind = fields.Char('Kind', select=True)
+    state = fields.Char('State', select=True)
+    count = fields.Integer('Count')
+    unread = fields.Integer('Unread',
+        help='Number of helpdesks with unread talks.')
+    unread_talks = fields.Integer('Unread Talks')
+
+    @classmethod
+    def __setup__(cls):
+        super(HelpdeskSummary, cls).__setup__()
+        cls.__rpc__.update({
+                'get_summary': RPC(readonly=True),
+                })
+
+    @classmethod
+    def __register__(cls, module_name):
+        exist = backend.TableHandler.table_exist(cls._table)
+
+        super(HelpdeskSummary, cls).__register__(module_name)
+
+        table_h = cls.__table_handler__(module_name)
+        table_h.index_action(['employee', 'kind', 'state'], 'add')
+
+        if not exist:
+            cls.update_summary()
+
+    @classmethod
+    def get_values(cls, helpdesk_ids):
+        '''Return the summary key and unread count of the helpdesks
+
+        The result is a list to be compared before and after a change.
+        '''
+        Helpdesk = Pool().get('helpdesk')
+        helpdesk = Helpdesk.__table__()
+        cursor = Transaction().connection.cursor()
+
+        values = []
+        for sub_ids in grouped_slice(list(set(helpdesk_ids))):
+            cursor.execute(*helpdesk.select(
+                    helpdesk.employee, helpdesk.kind, helpdesk.state,
+                    helpdesk.unread_count,
+                    where=reduce_ids(helpdesk.id, sub_ids)))
+            values.extend(cursor.fetchall())
+        return values
+
+    @classmethod
+    def set_summary(cls, old_values, new_values):
+        '''Defer the deltas between the get_values of the helpdesks before
+        and after a change to the commit'''
+        datamanager = Transaction().join(SummaryDataManager())
+        for values, sign in [(old_values, -1), (new_values, 1)]:
+            for employee, kind, state, unread_count in values:
+                delta = datamanager.deltas.setdefault(
+                    (employee, kind, state), [0, 0, 0])
+                delta[0] += sign
+                delta[1] += sign * int(bool(unread_count))
+                delta[2] += sign * (unread_count or 0)
+
+    @classmethod
+    def apply_deltas(cls, deltas):
+        '''Add the deltas of the (employee, kind, state) keys to the counters
+
+        The keys are updated in the same order by all the transactions to
+        not deadlock. A row whose counters reach zero is deleted.
+        '''
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        def equal(column, value):
+            return column == value if value is not None else column == Null
+
+        for key in sorted(deltas, key=repr):
+            employee, kind, state = key
+            delta = deltas[key]
+            cursor.execute(*table.select(Min(table.id),
+                    where=equal(table.employee, employee)
+                    & equal(table.kind, kind)
+                    & equal(table.state, state)))
+            row_id, = cursor.fetchone()
+            if row_id is None:
+                cursor.execute(*table.insert([table.employee, table.kind,
+                            table.state, table.count, table.unread,
+                            table.unread_talks],
+                        [[employee, kind, state] + list(delta)]))
+                continue
+            cursor.execute(*table.update(
+                    [table.count, table.unread, table.unread_talks],
+                    [table.count + delta[0], table.unread + delta[1],
+                        table.unread_talks + delta[2]],
+                    where=table.id == row_id))
+            cursor.execute(*table.delete(where=(table.id == row_id)
+                    & (table.count == 0) & (table.unread == 0)
+                    & (table.unread_talks == 0)))
+        clear_cache(cls)
+
+    @classmethod
+    def update_summary(cls):
+        '''Rebuild the counters of all the (employee, kind, state) keys
+
+        It is used by the migration and to repair the summary.
+        '''
+        Helpdesk = Pool().get('helpdesk')
+        table = cls.__table__()
+        helpdesk = Helpdesk.__table__()
+        cursor = Transaction().connection.cursor()
+
+        cursor.execute(*table.delete())
+        cursor.execute(*table.insert([table.employee, table.kind,
+                    table.state, table.count, table.unread,
+                    table.unread_talks],
+                helpdesk.select(helpdesk.employee, helpdesk.kind,
+                    helpdesk.state, Count(Literal('*')),
+                    Sum(Case((helpdesk.unread_count > 0, 1), else_=0)),
+                    Sum(Coalesce(helpdesk.unread_count, 0)),
+                    group_by=[helpdesk.employee, helpdesk.kind,
+                        helpdesk.state])))
+        clear_cache(cls)
+
+    @classmethod
+    def get_summary(cls, kind=None):
+        '''Return the counters of the helpdesk tabs
+
+        The result contains for the employee of the context ("my") and for
+        all the employees ("all") the number of helpdesks by state, the
+        unread helpdesks and the total.
+        '''
+        employee = Transaction().context.get('employee')
+        domain = []
+        if kind:
+            domain.append(('kind', '=', kind))
+        summary = {}
+        for name in ['my', 'all']:
+            summary[name] = {
+                'unread': 0,
+                'draft': 0,
+                'pending': 0,
+                'open': 0,
+                'done': 0,
+                'all': 0,
+                }
+        for record in cls.search(domain):
+            for name in ['my', 'all']:
+                if (name == 'my'
+                        and (not employee
+                            or record.employee is None
+                            or record.employee.id != employee)):
+                    continue
+                counters = summary[name]
+                counters['unread'] += record.unread
+                counters.setdefault(record.state, 0)
+                counters[record.state] += record.count
+                counters['all'] += record.count
+        return summary
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super(Cron, cls).__setup__()
+        cls.method.selection.append(
+            ('helpdesk.summary|update_summary', 'Rebuild Helpdesk Summary'))
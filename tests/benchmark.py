@@ -0,0 +1,321 @@
+# This file is part of the helpdesk module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+'''Benchmark of the helpdesk ingestion, sending and list loading
+
+It is not part of the test suite. Run it with:
+
+    DB_NAME=:memory: python -m trytond.modules.helpdesk.tests.benchmark
+
+or on PostgreSQL with TRYTOND_DATABASE__URI=postgresql:// and DB_NAME set
+to a test database. The results are written as JSON to the standard output
+or to the --output file so they can be compared between runs.
+'''
+import argparse
+import json
+import os
+import random
+import socketserver
+import sys
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+from email.utils import format_datetime, make_msgid
+
+os.environ.setdefault('DB_NAME', ':memory:')
+
+from trytond import backend
+from trytond.pool import Pool
+from trytond.tests.test_tryton import activate_module, DB_NAME
+from trytond.transaction import Transaction
+
+Message = namedtuple('Message', ['message_id', 'from_addr', 'cc',
+        'references', 'in_reply_to', 'title', 'body', 'date', 'attachments'])
+
+REFERENCE_SEPARATORS = {
+    'hotmail': ',',
+    'gmail': '\r\n',
+    'yahoo': ' ',
+    }
+LOGO = b'\x89PNG\r\n\x1a\n' + b'logo' * 1024
+
+WORDS = ('order invoice delivery refund broken package support account '
+    'password login shipment payment address customer warranty').split()
+
+
+class Mailbox(object):
+    'Generate synthetic email messages grouped in threads'
+
+    def __init__(self, threads=100, max_depth=8, seed=0):
+        self.threads = threads
+        self.max_depth = max_depth
+        self.random = random.Random(seed)
+
+    def text(self, words):
+        return ' '.join(self.random.choice(WORDS) for _ in range(words))
+
+    def body(self, depth):
+        paragraphs = ''.join('<p>%s</p>' % self.text(40)
+            for _ in range(self.random.randint(1, 4)))
+        quote = ''.join('<blockquote>%s</blockquote>' % self.text(30)
+            for _ in range(depth))
+        return ('<html><body><div>%s</div>%s'
+            '<p>Customer &lt;customer@example.com&gt;</p></body></html>'
+            % (paragraphs, quote))
+
+    def attachments(self):
+        attachments = []
+        # Signatures and logos are attached again on each reply
+        if self.random.random() < 0.5:
+            attachments.append(('logo.png', LOGO))
+        if self.random.random() < 0.2:
+            name = 'report-%s.pdf' % self.random.randint(0, 10 ** 6)
+            attachments.append((name, os.urandom(
+                        self.random.randint(1, 64) * 1024)))
+        return attachments
+
+    def messages(self):
+        'Return the messages of all the threads from the newest'
+        messages = []
+        start = datetime(2020, 1, 1)
+        for thread in range(self.threads):
+            style = self.random.choice(list(REFERENCE_SEPARATORS))
+            sender = 'customer%s@example.com' % self.random.randint(
+                0, self.threads // 2)
+            subject = self.text(5)
+            date = start + timedelta(hours=thread)
+            message_ids = []
+            for depth in range(self.random.randint(1, self.max_depth)):
+                message_id = make_msgid(domain='example.com')
+                references = REFERENCE_SEPARATORS[style].join(message_ids)
+                message_date = date + timedelta(minutes=10 * depth)
+                messages.append((message_date, Message(
+                        message_id=message_id,
+                        from_addr='Customer <%s>' % sender,
+                        cc=('other@example.com' if depth % 3 == 2
+                            else None),
+                        references=references or None,
+                        in_reply_to=message_ids[-1] if message_ids else None,
+                        title=('Re: ' if depth else '') + subject,
+                        body=self.body(depth),
+                        date=format_datetime(message_date),
+                        attachments=self.attachments(),
+                        )))
+                message_ids.append(message_id)
+        # getmail receives the messages from the newest to the oldest
+        messages.sort(key=lambda m: m[0], reverse=True)
+        return [m for _, m in messages]
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    'Accept the SMTP commands and discard the messages'
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply('220 localhost benchmark')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            command = line.decode('ascii', 'replace').strip().upper()
+            if command.startswith('EHLO'):
+                self.wfile.write(b'250-localhost\r\n')
+                self.reply('250 8BITMIME')
+            elif command.startswith('DATA'):
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                while self.rfile.readline() not in (b'.\r\n', b''):
+                    pass
+                self.server.messages += 1
+                self.reply('250 OK')
+            elif command.startswith('QUIT'):
+                self.reply('221 Bye')
+                break
+            else:
+                self.reply('250 OK')
+
+
+class SMTPSink(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    'Local SMTP server that counts the connections and messages'
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        socketserver.TCPServer.__init__(self, ('127.0.0.1', 0),
+            SMTPSinkHandler)
+        self.connections = 0
+        self.messages = 0
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+
+
+class Benchmark(object):
+    'Run and time the helpdesk operations'
+
+    def __init__(self, mailbox, sink):
+        self.mailbox = mailbox
+        self.sink = sink
+        self.results = {}
+
+    def time(self, name, function, count):
+        start = time.perf_counter()
+        function()
+        seconds = time.perf_counter() - start
+        self.results[name] = {
+            'seconds': round(seconds, 6),
+            'count': count,
+            'per_second': round(count / seconds, 2) if seconds else None,
+            }
+        return seconds
+
+    def setup(self):
+        'Create the company, employee and SMTP server of the benchmark'
+        from trytond.modules.company.tests import (create_company,
+            set_company, create_employee)
+        pool = Pool()
+        User = pool.get('res.user')
+        SMTP = pool.get('smtp.server')
+        Model = pool.get('ir.model')
+
+        company = create_company()
+        with set_company(company):
+            employee = create_employee(company)
+        User.write([User(Transaction().user)], {
+                'companies': [('add', [company.id])],
+                'company': company.id,
+                'employees': [('add', [employee.id])],
+                'employee': employee.id,
+                'email': 'agent@example.com',
+                })
+        model, = Model.search([('model', '=', 'helpdesk')])
+        SMTP.create([{
+                    'name': 'Benchmark',
+                    'smtp_server': self.sink.server_address[0],
+                    'smtp_port': self.sink.server_address[1],
+                    'smtp_ssl': False,
+                    'smtp_tls': False,
+                    'smtp_email': 'support@example.com',
+                    'state': 'done',
+                    'default': True,
+                    'models': [('add', [model.id])],
+                    }])
+        Transaction().commit()
+
+    def getmail(self):
+        pool = Pool()
+        Helpdesk = pool.get('helpdesk')
+        GetMail = pool.get('getmail.server')
+
+        messages = self.mailbox.messages()
+        server = GetMail(attachment=True, kind='generic')
+
+        def run():
+            Helpdesk.getmail(server, messages)
+            Transaction().commit()
+        self.time('getmail', run, len(messages))
+
+    def send_email(self):
+        Helpdesk = Pool().get('helpdesk')
+
+        helpdesks = Helpdesk.search([])
+        Helpdesk.write(helpdesks, {'message': 'Thanks for your email.'})
+        Transaction().commit()
+        connections = self.sink.connections
+
+        def run():
+            Helpdesk.send_email(helpdesks)
+            # The emails are sent when the transaction is committed
+            Transaction().commit()
+        self.time('send_email', run, len(helpdesks))
+        self.results['send_email']['smtp_connections'] = (
+            self.sink.connections - connections)
+
+    def search_unread(self):
+        Helpdesk = Pool().get('helpdesk')
+        result = []
+
+        def run():
+            result.extend(Helpdesk.search([('unread', '=', True)]))
+        self.time('search_unread', run, 1)
+        self.results['search_unread']['records'] = len(result)
+
+    def display_text(self):
+        HelpdeskTalk = Pool().get('helpdesk.talk')
+
+        talks = HelpdeskTalk.search([])
+        self.time('get_display_text', lambda: HelpdeskTalk.read(
+                [t.id for t in talks], ['display_text']), len(talks))
+
+    def list_read(self):
+        Helpdesk = Pool().get('helpdesk')
+
+        fields_names = ['name', 'party', 'employee', 'email_from',
+            'last_talk', 'num_attach', 'unread', 'state', 'priority']
+        count = Helpdesk.search_count([])
+        self.time('list_read', lambda: Helpdesk.search_read([], limit=1000,
+                fields_names=fields_names), min(count, 1000))
+
+    def run(self):
+        self.setup()
+        self.getmail()
+        self.send_email()
+        # Clear the transaction cache before the read benchmarks
+        Transaction().commit()
+        self.search_unread()
+        self.display_text()
+        self.list_read()
+        return self.results
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=100,
+        help='number of email threads')
+    parser.add_argument('--depth', type=int, default=8,
+        help='maximum number of messages of each thread')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='file of the JSON results')
+    options = parser.parse_args(arguments)
+
+    activate_module(['helpdesk', 'getmail'])
+    sink = SMTPSink()
+    sink.start()
+    mailbox = Mailbox(threads=options.threads, max_depth=options.depth,
+        seed=options.seed)
+    try:
+        with Transaction().start(DB_NAME, 1) as transaction:
+            results = Benchmark(mailbox, sink).run()
+            transaction.rollback()
+    finally:
+        sink.shutdown()
+        sink.server_close()
+
+    output = {
+        'date': datetime.now().isoformat(),
+        'backend': backend.name,
+        'parameters': {
+            'threads': options.threads,
+            'depth': options.depth,
+            'seed': options.seed,
+            },
+        'results': results,
+        'smtp': {
+            'connections': sink.connections,
+            'messages': sink.messages,
+            },
+        }
+    if options.output:
+        with open(options.output, 'w') as file_:
+            json.dump(output, file_, indent=2, sort_keys=True)
+    else:
+        json.dump(output, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,422 @@
 # This file is part of the helpdesk module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import logging
 import unittest
+from collections import namedtuple
+from datetime import datetime
+from unittest.mock import patch
 import trytond.tests.test_tryton
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+from trytond.modules.company.tests import (create_company, set_company,
+    create_employee)
+from trytond.modules.helpdesk.archive import compress
+from trytond.modules.helpdesk.helpdesk import (lock_key, try_lock,
+    parse_references, thread_root, strip_reply)
+from trytond.modules.helpdesk.ingest import IngestStats
+from trytond.modules.helpdesk.summary import SummaryDataManager
+
+Message = namedtuple('Message', ['message_id', 'references', 'in_reply_to'])
+Mail = namedtuple('Mail', ['message_id', 'from_addr', 'cc', 'title', 'date',
+        'references', 'in_reply_to', 'body'])
+Server = namedtuple('Server', ['attachment', 'kind', 'rec_name'])
 
 
 class HelpdeskTestCase(ModuleTestCase):
     'Test Helpdesk module'
     module = 'helpdesk'
+    extras = ['getmail']
+
+    @with_transaction()
+    def test_archive(self):
+        'Test archive and unarchive keep the talks'
+        pool = Pool()
+        Helpdesk = pool.get('helpdesk')
+        HelpdeskTalk = pool.get('helpdesk.talk')
+
+        helpdesk, = Helpdesk.create([{'name': 'Test'}])
+        talk, = HelpdeskTalk.create([{
+                    'helpdesk': helpdesk.id,
+                    'message': 'Question',
+                    'message_id': '<1@example.com>',
+                    'original_compressed': compress('Question\n> Old'),
+                    }])
+        reply, = HelpdeskTalk.create([{
+                    'helpdesk': helpdesk.id,
+                    'message': 'Answer',
+                    'parent': talk.id,
+                    }])
+        values = [(t.id, t.parent, t.path, t.depth, t.message, t.original)
+            for t in HelpdeskTalk.browse([talk.id, reply.id])]
+
+        Helpdesk.archive([helpdesk])
+        helpdesk = Helpdesk(helpdesk.id)
+        self.assertTrue(helpdesk.archived)
+        self.assertEqual(HelpdeskTalk.search([
+                    ('helpdesk', '=', helpdesk.id),
+                    ]), [])
+        self.assertEqual(
+            sorted((a.talk_id, a.message, a.original)
+                for a in helpdesk.archived_talks),
+            [(talk.id, 'Question', 'Question\n> Old'),
+                (reply.id, 'Answer', 'Answer')])
+
+        Helpdesk.unarchive([helpdesk])
+        self.assertFalse(Helpdesk(helpdesk.id).archived)
+        talks = HelpdeskTalk.search([
+                ('helpdesk', '=', helpdesk.id),
+                ], order=[('id', 'ASC')])
+        self.assertEqual(
+            [(t.id, t.parent, t.path, t.depth, t.message, t.original)
+                for t in talks], values)
+
+    @with_transaction()
+    def test_search_keyset(self):
+        'Test the keyset pages do not overlap nor skip helpdesks'
+        Helpdesk = Pool().get('helpdesk')
+
+        date = datetime(2020, 1, 1)
+        Helpdesk.create([{
+                    'name': 'Test %s' % i,
+                    'priority': priority,
+                    'date': date,
+                    } for i, priority in enumerate(
+                    ['3', '3', '1', '3', '3', '1', '4', '3'])])
+        expected = Helpdesk.search([], order=[
+                ('priority', 'ASC NULLS LAST'),
+                ('date', 'DESC NULLS FIRST'),
+                ('id', 'DESC'),
+                ])
+
+        ids, key = [], None
+        for _ in range(len(expected)):
+            page, key = Helpdesk.search_keyset([], key=key, limit=3)
+            ids.extend(page)
+            if not key:
+                break
+        self.assertEqual(ids, [h.id for h in expected])
+        self.assertEqual(len(ids), len(set(ids)))
+
+    def test_parse_references(self):
+        'Test the references of the mail clients are split'
+        for references, expected in [
+                ('<1@a>,<2@a>', ['<1@a>', '<2@a>']),
+                ('<1@a>\r\n <2@a>', ['<1@a>', '<2@a>']),
+                ('<1@a> <2@a>', ['<1@a>', '<2@a>']),
+                ('<1@a>', ['<1@a>']),
+                (None, ['<3@a>']),
+                ('  ', ['<3@a>']),
+                ]:
+            self.assertEqual(
+                parse_references(references, '<3@a>'), expected)
+        self.assertEqual(parse_references('<1@a>', '<3@a>', '<2@a>'),
+            ['<1@a>', '<2@a>'])
+
+    def test_thread_root(self):
+        'Test the root of the thread is the first message'
+        self.assertEqual(thread_root('<1@a> <2@a>', '<3@a>', '<2@a>'),
+            '<1@a>')
+        self.assertEqual(thread_root(None, '<3@a>', ' <2@a> '), '<2@a>')
+        self.assertEqual(thread_root(None, '<3@a>'), '<3@a>')
+
+    @with_transaction()
+    def test_talk_tree(self):
+        'Test the talks are ordered as the thread tree'
+        pool = Pool()
+        Helpdesk = pool.get('helpdesk')
+        HelpdeskTalk = pool.get('helpdesk.talk')
+
+        helpdesk, = Helpdesk.create([{'name': 'Test'}])
+        root, = HelpdeskTalk.create([{
+                    'helpdesk': helpdesk.id,
+                    'message': 'Root',
+                    }])
+        first, second = HelpdeskTalk.create([{
+                    'helpdesk': helpdesk.id,
+                    'message': 'First',
+                    'parent': root.id,
+                    }, {
+                    'helpdesk': helpdesk.id,
+                    'message': 'Second',
+                    'parent': root.id,
+                    }])
+        reply, = HelpdeskTalk.create([{
+                    'helpdesk': helpdesk.id,
+                    'message': 'Reply',
+                    'parent': first.id,
+                    }])
+        other, = HelpdeskTalk.create([{
+                    'helpdesk': helpdesk.id,
+                    'message': 'Other',
+                    }])
+
+        reply = HelpdeskTalk(reply.id)
+        self.assertEqual(reply.depth, 2)
+        self.assertEqual(reply.path,
+            '/%010d/%010d/%010d/' % (root.id, first.id, reply.id))
+        self.assertEqual(HelpdeskTalk.get_tree(helpdesk),
+            [root, first, reply, second, other])
+        self.assertEqual(HelpdeskTalk(first.id).get_branch(),
+            [root, first, reply])
+        self.assertEqual(HelpdeskTalk(other.id).get_branch(), [other])
+
+    @with_transaction()
+    def test_getmail_quarantine(self):
+        'Test the failing emails are quarantined and skipped'
+        pool = Pool()
+        Helpdesk = pool.get('helpdesk')
+        Configuration = pool.get('helpdesk.configuration')
+        Quarantine = pool.get('helpdesk.quarantine')
+
+        configuration = Configuration(1)
+        configuration.getmail_chunk_size = 2
+        configuration.save()
+
+        def mail(message_id):
+            return Mail(message_id, 'test@example.com', None, 'Test', None,
+                None, None, 'Body')
+
+        loaded = []
+
+        def _getmail(server, messages):
+            if any(m.message_id == '<2@example.com>' for m in messages):
+                raise ValueError('Invalid email')
+            loaded.extend(m.message_id for m in messages)
+
+        # The chunks commit, keep the test data in the test transaction
+        with patch.object(Transaction, 'commit'), \
+                patch.object(Transaction, 'rollback'), \
+                patch.object(Helpdesk, '_getmail', side_effect=_getmail):
+            # getmail receives the newest messages first
+            Helpdesk.getmail(None, [
+                    mail('<3@example.com>'),
+                    mail('<2@example.com>'),
+                    mail('<1@example.com>'),
+                    ])
+            self.assertEqual(loaded, ['<1@example.com>', '<3@example.com>'])
+            quarantine, = Quarantine.search([])
+            self.assertEqual(quarantine.message_id, '<2@example.com>')
+            self.assertIn('Invalid email', quarantine.error)
+
+            del loaded[:]
+            Helpdesk.getmail(None, [
+                    mail('<4@example.com>'),
+                    mail('<2@example.com>'),
+                    ])
+            self.assertEqual(loaded, ['<4@example.com>'])
+            self.assertEqual(len(Quarantine.search([])), 1)
+
+    def test_strip_reply(self):
+        'Test the quoted messages are stripped of the replies'
+        for text, expected in [
+                # Reply headers
+                ('Ok\n\nOn Mon, 1 Jan 2020, A <a@example.com> wrote:\n\n'
+                    '> Old\n> text', 'Ok'),
+                ('Ok\n\nEl lun, 1 ene 2020, A\n<a@example.com> escribió:\n'
+                    '> Old', 'Ok'),
+                ('Yes\n\n-----Original Message-----\nFrom: A\nOld', 'Yes'),
+                ('Thanks\n\nFrom: A <a@example.com>\nSent: Monday\nTo: B\n'
+                    'Subject: Re: Test\n\nOld', 'Thanks'),
+                ('Thanks\n\n* * *\n\n**From:** A\n**Sent:** Monday\n\n'
+                    'Old', 'Thanks'),
+                ('Thanks\n\n________________________________\nDe: A\n'
+                    'Enviado: lunes\n\nOld', 'Thanks'),
+                # Inline replies
+                ('On Mon, A wrote:\n\n> Question 1\n\nAnswer 1\n\n'
+                    '> Question 2\n\nAnswer 2\n\n> Bye',
+                    'On Mon, A wrote:\n\n> Question 1\n\nAnswer 1\n\n'
+                    '> Question 2\n\nAnswer 2'),
+                # Quotes only
+                ('> Only\n> quoted', '> Only\n> quoted'),
+                # False positives
+                ('Please call.\nFrom: the warehouse\nDate: tomorrow\n'
+                    'The rest of the text',
+                    'Please call.\nFrom: the warehouse\nDate: tomorrow\n'
+                    'The rest of the text'),
+                ('On the road again\nwe go', 'On the road again\nwe go'),
+                ('', ''),
+                ]:
+            self.assertEqual(strip_reply(text), expected)
+
+    @with_transaction()
+    def test_add_reply_without_email(self):
+        'Test the reply quotes the last talk when the user has no email'
+        pool = Pool()
+        Helpdesk = pool.get('helpdesk')
+        HelpdeskTalk = pool.get('helpdesk.talk')
+        User = pool.get('res.user')
+
+        User.write([User(Transaction().user)], {'email': None})
+        helpdesk, = Helpdesk.create([{'name': 'Test'}])
+        talk, = HelpdeskTalk.create([{
+                    'helpdesk': helpdesk.id,
+                    'email': 'customer@example.com',
+                    'message': 'Question\nDetails',
+                    }])
+
+        Helpdesk.add_reply([helpdesk])
+        helpdesk = Helpdesk(helpdesk.id)
+        self.assertEqual(helpdesk.message, '> Question\n> Details')
+
+        Helpdesk.write([helpdesk], {'message': 'Answer'})
+        note, = Helpdesk._talk([helpdesk])
+        self.assertEqual(note.email, None)
+        self.assertEqual(note.parent, talk)
+
+    @with_transaction()
+    def test_summary(self):
+        'Test the summary deltas give the rebuilt summary'
+        pool = Pool()
+        Helpdesk = pool.get('helpdesk')
+        HelpdeskTalk = pool.get('helpdesk.talk')
+        Summary = pool.get('helpdesk.summary')
+        transaction = Transaction()
+
+        def apply_deltas():
+            # The deltas are applied on commit
+            datamanager = transaction.join(SummaryDataManager())
+            datamanager.commit(transaction)
+            datamanager._finish()
+
+        company = create_company()
+        with set_company(company):
+            employee = create_employee(company)
+            first, second, third, fourth = Helpdesk.create([{
+                        'name': 'First',
+                        'employee': employee.id,
+                        }, {
+                        'name': 'Second',
+                        }, {
+                        'name': 'Third',
+                        'employee': employee.id,
+                        }, {
+                        'name': 'Fourth',
+                        }])
+            HelpdeskTalk.create([{
+                        'helpdesk': first.id,
+                        'message': 'Question',
+                        'unread': True,
+                        }, {
+                        'helpdesk': first.id,
+                        'message': 'Again',
+                        'unread': True,
+                        }, {
+                        'helpdesk': second.id,
+                        'message': 'Question',
+                        'unread': True,
+                        }])
+            Helpdesk.write([first], {
+                    'state': 'open',
+                    }, [second], {
+                    'employee': employee.id,
+                    'state': 'pending',
+                    })
+            Helpdesk.write([third], {'employee': None})
+            Helpdesk.delete([fourth])
+            apply_deltas()
+
+            # The rows of the keys without helpdesks are deleted
+            self.assertEqual(Summary.search([
+                        ('employee', '=', employee.id),
+                        ('state', '=', 'draft'),
+                        ]), [])
+            with transaction.set_context(employee=employee.id):
+                summary = Summary.get_summary()
+                self.assertEqual(summary['my'], {
+                        'unread': 2,
+                        'draft': 0,
+                        'pending': 1,
+                        'open': 1,
+                        'done': 0,
+                        'all': 2,
+                        })
+                self.assertEqual(summary['all']['all'], 3)
+                self.assertEqual(summary['all']['draft'], 1)
+                self.assertEqual(
+                    sum(s.unread_talks for s in Summary.search([])), 3)
+
+                Summary.update_summary()
+                self.assertEqual(Summary.get_summary(), summary)
+
+    def test_ingest_stats_failure(self):
+        'Test the query counter is removed when the run fails'
+        stats = IngestStats('getmail')
+        logger = stats.queries.logger
+        level = logger.level
+        logger.setLevel(logging.DEBUG)
+        try:
+            with self.assertRaises(ValueError):
+                with stats:
+                    self.assertIn(stats.queries, logger.handlers)
+                    raise ValueError
+            self.assertNotIn(stats.queries, logger.handlers)
+        finally:
+            logger.setLevel(level)
+
+    @with_transaction()
+    def test_getmail_duplicate(self):
+        'Test the emails already loaded are skipped'
+        pool = Pool()
+        Helpdesk = pool.get('helpdesk')
+        HelpdeskTalk = pool.get('helpdesk.talk')
+        GetMail = pool.get('getmail.server')
+        Stat = pool.get('helpdesk.ingest.stat')
+
+        server = Server(False, None, 'Test')
+        message = Mail('<1@example.com>', 'customer@example.com', None,
+            'Test', None, None, None, 'Body')
+        with patch.object(GetMail, 'get_date',
+                return_value=datetime(2020, 1, 1)):
+            Helpdesk._getmail(server, [message])
+            Helpdesk._getmail(server, [message])
+
+        self.assertEqual(len(HelpdeskTalk.search([
+                        ('message_id', '=', '<1@example.com>'),
+                        ])), 1)
+        first, second = Stat.search([
+                ('kind', '=', 'getmail'),
+                ], order=[('id', 'ASC')])
+        self.assertEqual((first.talks, first.duplicates), (1, 0))
+        self.assertEqual((second.talks, second.duplicates), (0, 1))
+
+    def test_lock_key(self):
+        'Test the lock key is a stable signed 64 bits integer'
+        key = lock_key('helpdesk:<1@example.com>')
+        self.assertEqual(key, lock_key('helpdesk:<1@example.com>'))
+        self.assertNotEqual(key, lock_key('helpdesk:<2@example.com>'))
+        self.assertTrue(-2 ** 63 <= key < 2 ** 63)
+
+    @with_transaction()
+    def test_try_lock(self):
+        'Test try_lock locks the keys or falls back'
+        Helpdesk = Pool().get('helpdesk')
+        database = Transaction().database
+        try:
+            database.lock_id(0)
+            supported = True
+        except NotImplementedError:
+            supported = False
+
+        keys = ['helpdesk:<1@example.com>', 'helpdesk:<2@example.com>']
+        self.assertEqual(try_lock(keys), supported)
+        # The transaction can take again its locks
+        self.assertEqual(try_lock(keys), supported)
+
+        with patch.object(type(database), 'lock_id',
+                side_effect=NotImplementedError):
+            self.assertFalse(try_lock(keys))
+            # The threads fall back to a table lock
+            Helpdesk.lock_threads([
+                    Message('<2@example.com>', '<1@example.com>',
+                        '<1@example.com>'),
+                    ])
 
 
 def suite():
     suite = trytond.tests.test_tryton.suite()
     suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
         HelpdeskTestCase))
-    return suite
\ No newline at end of file
+    return suite